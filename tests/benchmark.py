@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmarks for WPTools (no network).
+
+    $ python -m tests.benchmark
+"""
+
+from __future__ import print_function
+
+import json
+import timeit
+
+import lxml.html
+
+import wptools
+
+from . import parse
+from . import rest
+
+
+def bench(name, stmt, number=10000):
+    """
+    print microseconds per call of stmt
+    """
+    secs = min(timeit.repeat(stmt, number=number, repeat=3))
+    print("%-40s %8.2f us" % (name, secs / number * 1e6))
+
+
+def bench_infobox():
+    """
+    infobox extraction from parse tree
+    """
+    ptree = json.loads(parse.response)['parse']['parsetree']
+    bench("utils.get_infobox(parsetree)",
+          lambda: wptools.utils.get_infobox(ptree), 100)
+
+    wikitext = json.loads(parse.response)['parse']['wikitext']
+    bench("utils.get_wikitext_infobox(wikitext)",
+          lambda: wptools.utils.get_wikitext_infobox(wikitext), 100)
+
+
+def bench_snip():
+    """
+    lead HTML sanitizing, vs snip_html() before single-pass rewrite
+    """
+    items = json.loads(rest.response)['sections'][0]['items']
+    html = "\n".join([x['text'] for x in items if x.get('text')])
+    bench("snip_html_v1(html)", lambda: snip_html_v1(html), 100)
+    bench("utils.snip_html(html)",
+          lambda: wptools.utils.snip_html(html), 100)
+
+    # one reference per paragraph, so both drop the same elements
+    html = "\n".join(['<p>a<sup class="reference"><a>[1]</a></sup>b</p>']
+                     * 500)
+    bench("snip_html_v1(500 refs)", lambda: snip_html_v1(html), 100)
+    bench("utils.snip_html(500 refs)",
+          lambda: wptools.utils.snip_html(html), 100)
+
+
+def snip_html_v1(text):
+    """
+    snip_html() as of 0.2.3 (verbose=0), for comparison
+    """
+
+    def _note(old, new):
+        lxml.html.tostring(old).strip()
+        lxml.html.tostring(new).strip()
+
+    def _span(note, text):
+        span = lxml.html.fromstring("<span %s>" % note)
+        span.tail = text
+        return span
+
+    def _exclude(_class):
+        return ('metadata' in _class
+                or 'noexcerpt' in _class
+                or 'noprint' in _class
+                or 'reference' in _class
+                or 'haudio' in _class)
+
+    keep = lxml.html.Element("span")
+    for elem in lxml.html.fromstring(text):
+        elem_class = elem.get('class')
+        if elem_class:
+            if _exclude(elem_class):
+                span = _span('ignored', elem.tail or '')
+                keep.append(span)
+                _note(elem, span)
+                continue
+
+        for desc in elem.iterdescendants():
+            desc_class = desc.get('class')
+            if desc_class:
+                if _exclude(desc_class):
+                    desc.getparent().remove(desc)
+                    span = _span('removed', desc.tail or '')
+                    _note(desc, span)
+                    elem.append(span)
+                    break
+
+        keep.append(elem)
+
+    leading_text = text.split('<')[0]
+    keep_html = lxml.html.tostring(keep, encoding='unicode')
+
+    return leading_text + keep_html
+
+
+def bench_page():
+    """
+    WPTools object creation
+    """
+    bench("page(title, silent=True)",
+          lambda: wptools.page('Douglas_Adams', silent=True))
+    bench("page(title, lazy=True)",
+          lambda: wptools.page('Douglas_Adams', lazy=True))
+    bench("page(lazy=True)",
+          lambda: wptools.page(lazy=True))
+
+
+def main():
+    """
+    run all benchmarks
+    """
+    bench_infobox()
+    bench_page()
+    bench_snip()
+
+
+if __name__ == '__main__':
+    main()
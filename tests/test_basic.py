@@ -5,9 +5,16 @@
 Basic tests for WPTools.
 """
 
+import json
+import time
 import unittest
 import wptools
 
+try:  # python3
+    import asyncio
+except ImportError:  # python2
+    asyncio = None
+
 from . import claims
 from . import imageinfo
 from . import parse
@@ -16,6 +23,112 @@ from . import rest
 from . import wikidata
 
 
+class FakeMulti(object):
+    """
+    fetch.WPToolsMulti stand-in that serves fixtures and records the
+    URLs of each perform() (round)
+    """
+
+    error = None
+    missing = False
+    rounds = []
+
+    def __init__(self, maxhost=6):
+        self.jobs = []
+
+    def add(self, _fetch, url):
+        job = {'error': self.error,
+               'info': {},
+               'response': self.respond(url),
+               'url': url}
+        self.jobs.append(job)
+        return job
+
+    def perform(self):
+        if self.jobs:
+            self.rounds.append([x['url'] for x in self.jobs])
+        return self.jobs
+
+    def respond(self, url):
+        if 'action=parse' in url:
+            return parse.response
+        if 'prop=imageinfo' in url:
+            return imageinfo.response
+        if 'props=labels&' in url:
+            return claims.response
+        if 'wbgetentities' in url:
+            if '&ids=Q42&' in url or ('&normalize=1' in url
+                                      and not self.missing):
+                return wikidata.response
+            return '{"entities": {"-1": {"missing": ""}}}'
+        if self.missing:
+            return '{"query": {"pages": [{"missing": true}]}}'
+        return query.response
+
+
+def serve(responses):
+    """
+    returns (server, url) of local keep-alive HTTP server (in a thread)
+    that answers GETs with (status, headers, body) responses in turn,
+    repeating the last one
+    """
+    import threading
+    try:  # python2
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+    except ImportError:  # python3
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+
+    responses = list(responses)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            status, headers, body = responses[0]
+            if len(responses) > 1:
+                responses.pop(0)
+            self.send_response(status)
+            for name in headers:
+                self.send_header(name, headers[name])
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:%d/" % server.server_address[1]
+
+
+class FakeMultiTestCase(unittest.TestCase):
+    """
+    replaces fetch.WPToolsMulti with FakeMulti, and the stores
+    """
+
+    def setUp(self):
+        self.saved = (wptools.fetch.WPToolsMulti, wptools.store.IMAGES,
+                      wptools.store.LABELS)
+        wptools.fetch.WPToolsMulti = FakeMulti
+        wptools.store.IMAGES = wptools.store.LRUStore()
+        wptools.store.LABELS = wptools.store.LRUStore()
+        FakeMulti.error = None
+        FakeMulti.missing = False
+        FakeMulti.rounds = []
+
+    def tearDown(self):
+        (wptools.fetch.WPToolsMulti, wptools.store.IMAGES,
+         wptools.store.LABELS) = self.saved
+
+
 class WPToolsTestCase(unittest.TestCase):
 
     def test_entry_points(self):
@@ -71,6 +184,201 @@ class WPToolsCoreTestCase(unittest.TestCase):
         self.assertTrue('science' in page.wikidata['genre'].lower())
         self.assertTrue('Mostly Harmless' in page.wikidata['work'])
 
+    def test_claims_labels(self):
+        labels = wptools.store.LABELS
+        wptools.store.LABELS = wptools.store.LRUStore()
+        try:
+            page = wptools.page('test_claims_labels', silent=True)
+            page.cache['wikidata'] = wikidata.cache
+            page._set_wikidata()
+            page.cache['claims'] = claims.cache
+            page._set_claims_data()
+            self.assertEqual(len(wptools.store.LABELS), 11)
+
+            again = wptools.page('test_claims_labels', silent=True)
+            again.cache['wikidata'] = wikidata.cache
+            again._set_wikidata()
+            wptools.store.LABELS.data.pop('Q5|en')
+            self.assertFalse(again._skip('claims'))
+            self.assertEqual(sorted(again.wikidata['work']),
+                             sorted(page.wikidata['work']))
+            query = again._query('claims', again._fetch(None, 0))
+            self.assertTrue('&ids=Q5&' in query)
+            wptools.store.LABELS.set('Q5|en', 'human')
+            self.assertTrue(again._skip('claims'))
+            self.assertEqual(again.what, 'human')
+        finally:
+            wptools.store.LABELS = labels
+
+    def test_claims_chunks(self):
+        page = wptools.page('test_claims_chunks', silent=True)
+        page.claims = dict(('Q%d' % x, 'work') for x in range(1, 121))
+        requests = page._queries('claims', None, 0)
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(requests[2][1].split('&ids=')[1].count('|'), 19)
+        merged = page._merge_responses(
+            [claims.response, '{"entities": {"Q1": {"id": "Q1"}}}'])
+        self.assertEqual(len(merged['entities']), 12)
+
+    def test_imageinfo_store(self):
+        images = wptools.store.IMAGES
+        wptools.store.IMAGES = wptools.store.LRUStore()
+        try:
+            page = wptools.page('test_imageinfo_store', silent=True)
+            page.images = [{'file': 'Douglas adams portrait cropped.jpg'}]
+            page.cache['imageinfo'] = imageinfo.cache
+            page._set_imageinfo_data()
+            self.assertEqual(len(wptools.store.IMAGES), 1)
+
+            again = wptools.page('test_imageinfo_store', silent=True)
+            again.images = [{'file': 'Douglas_adams_portrait_cropped.jpg',
+                             'kind': 'parse-image'},
+                            {'file': 'Image:other.jpg', 'kind': 'test'}]
+            self.assertFalse(again._skip('imageinfo'))
+            self.assertEqual(again.images[0]['url'], page.images[0]['url'])
+            self.assertEqual(again.images[0]['kind'], 'parse-image')
+            query = again._query('imageinfo', again._fetch(None, 0))
+            self.assertTrue(query.endswith('&titles=File%3AOther.jpg'))
+            wptools.store.IMAGES.set('File:Other.jpg', {'url': 'other'})
+            self.assertTrue(again._skip('imageinfo'))
+            self.assertEqual(again.images[1]['url'], 'other')
+        finally:
+            wptools.store.IMAGES = images
+
+    def test_offline_images(self):
+        images = wptools.store.IMAGES
+        wptools.store.IMAGES = wptools.store.LRUStore()
+        try:
+            page = wptools.page('test_offline_images', silent=True,
+                                offline_images=True, thumbs=[220])
+            page.cache['wikidata'] = wikidata.cache
+            page._set_response('wikidata', 'test', wikidata.response, {})
+            image = page.images[0]
+            self.assertTrue('/c/c0/' in image['url'])
+            self.assertTrue('/thumb/c/c0/' in image['thumbs'][220])
+            self.assertTrue('/commons.' in image['descriptionurl'])
+            self.assertFalse('size' in image)
+            self.assertFalse(page._missing_imageinfo())
+
+            wptools.store.IMAGES.set(image['file'], {'size': 32915})
+            self.assertEqual(image['size'], 32915)
+            self.assertEqual(image.get('width'), None)
+        finally:
+            wptools.store.IMAGES = images
+
+    def test_imageinfo_chunks(self):
+        page = wptools.page('test_imageinfo_chunks', silent=True)
+        page.images = [{'file': 'File:%d.jpg' % x} for x in range(1, 121)]
+        page.images.append({'file': 'File:1.jpg', 'url': 'known'})
+        self.assertEqual(len(page._imageinfo_files()), 120)
+        requests = page._queries('imageinfo', None, 0)
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(requests[2][1].split('&titles=')[1].count('|'), 19)
+        merged = page._merge_responses(
+            [imageinfo.response, '{"query": {"pages": [{"title": "x"}]}}'])
+        self.assertEqual(len(merged['query']['pages']), 2)
+
+    def test_plan(self):
+        page = wptools.page('test_plan', silent=True)
+        self.assertEqual(page._plan(['infobox', 'wikibase']),
+                         (['parse'], set()))
+        self.assertEqual(page._plan(['description', 'what']),
+                         (['wikidata'], set(['claims'])))
+        self.assertEqual(page._plan(['extext', 'infobox']),
+                         (['query', 'parse'], set()))
+        self.assertEqual(page._plan(['image', 'lead']),
+                         (['rest'], set(['imageinfo'])))
+        page = wptools.page(wikibase='Q42', silent=True)
+        self.assertEqual(page._plan(['infobox'])[0], ['wikidata', 'parse'])
+        for field in ['description', 'label', 'title']:
+            self.assertEqual(page._plan([field])[0], ['wikidata'])
+        page = wptools.page(pageid=8091, silent=True)
+        self.assertEqual(page._plan(['wikidata'])[0], ['query', 'wikidata'])
+        self.assertEqual(page._plan(['lead'])[0], ['query', 'rest'])
+        self.assertEqual(page._plan(['infobox'])[0], ['parse'])
+        self.assertRaises(ValueError, page._plan, ['nope'])
+
+    def test_parse_props(self):
+        page = wptools.page('test_parse_props', silent=True)
+        _fetch = page._fetch(None, 0)
+        qry = page._query('parse', _fetch)
+        self.assertTrue('prop=iwlinks|parsetree|wikitext|properties' in qry)
+        self.assertTrue('&section=' not in qry)
+        page._parse_fields = ['infobox', 'wikibase']
+        page._parse_section = 0
+        qry = page._query('parse', _fetch)
+        self.assertTrue('prop=parsetree|properties' in qry)
+        self.assertTrue(qry.endswith('&section=0'))
+        page._set_response('parse', qry, json.dumps(
+            {'parse': {'pageid': 1, 'title': 'test_parse_props',
+                       'properties': {'wikibase_item': 'Q1'}}}), {})
+        self.assertEqual(page.wikibase, 'Q1')
+        self.assertTrue(page.infobox is None and page.wikitext is None)
+
+    def test_lazy(self):
+        pool = wptools.store.RANDOM
+        wptools.store.RANDOM = wptools.store.RandomPool(lowat=0)
+        try:
+            wptools.store.RANDOM.refill(('en', None, 0), lambda: [(1, 'A')])
+            page = wptools.page(lazy=True)
+            self.assertEqual(page.title, None)
+            self.assertTrue(page._ready('query'))
+            self.assertEqual((page.pageid, page.title), (1, 'A'))
+        finally:
+            wptools.store.RANDOM = pool
+
+    def test_lazy_attributes(self):
+        page = wptools.page('test_lazy_attributes', silent=True)
+        page._planned = set()
+        page._set_response('query', query.query, query.response, {})
+        page._set_response('parse', parse.query, parse.response, {})
+        self.assertEqual(sorted(page._deferred), ['extext', 'infobox'])
+        kinds = [x['kind'] for x in page.images]
+        self.assertTrue('parse-image' not in kinds)
+        self.assertEqual(len(page.infobox), 15)
+        self.assertTrue(page.extext.startswith('**Douglas'))
+        self.assertEqual(page._deferred, {})
+        kinds = [x['kind'] for x in page.images]
+        self.assertTrue('parse-image' in kinds)
+        page.infobox = None
+        self.assertEqual(page.infobox, None)
+
+    def test_lazy_pickle(self):
+        import pickle
+        page = wptools.page('test_lazy_pickle', silent=True)
+        page._planned = set()
+        page._set_response('query', query.query, query.response, {})
+        page._set_response('parse', parse.query, parse.response, {})
+        page._set_response('rest', rest.query, rest.response, {})
+        self.assertEqual(sorted(page._deferred),
+                         ['extext', 'infobox', 'lead'])
+        copy = pickle.loads(pickle.dumps(page))
+        self.assertEqual(copy._deferred, {})
+        self.assertEqual(copy.infobox, page.infobox)
+        self.assertEqual(copy.lead, page.lead)
+        self.assertTrue(copy.extext.startswith('**Douglas'))
+
+    def test_response_data(self):
+        page = wptools.page('test_response_data', silent=True)
+        page._set_response('parse', parse.query, parse.response, {})
+        self.assertEqual(page.cache['parse']['response'], parse.response)
+        self.assertTrue(page.response('parse') is page.response('parse'))
+        page = wptools.page('test_response_data', keep_raw=False,
+                            silent=True)
+        page._set_response('parse', parse.query, parse.response, {})
+        self.assertEqual(page.cache['parse']['response'], None)
+        self.assertEqual(page.response('parse')['parse']['pageid'], 8091)
+
+    def test_random(self):
+        page = wptools.page('test_random', silent=True)
+        url = page._fetch(None, 0).query('random', 5)
+        self.assertTrue('&generator=random&grnlimit=5&' in url)
+        item = wptools.utils.json_loads(query.response)['query']['pages'][0]
+        page._set_random(item, url, {})
+        self.assertEqual(page.title, 'Douglas_Adams')
+        self.assertEqual(page.description, 'English writer and humorist')
+        self.assertTrue('query' in page.cache)
+
     def test_get_wikidata(self):
         page = wptools.page('test_get_wikidata')
         page.cache['wikidata'] = wikidata.cache
@@ -140,8 +448,548 @@ class WPToolsCoreTestCase(unittest.TestCase):
         self.assertTrue(not abc.pageid)
 
 
+class WPToolsBatchTestCase(unittest.TestCase):
+
+    def test_split_query(self):
+        from wptools.batch import _handle, _split_query
+        page = wptools.page('Douglas_Adams', silent=True)
+        other = wptools.page('test_split_query', silent=True)
+        job = {'error': None,
+               'info': {},
+               'response': query.response,
+               'split': _split_query,
+               'url': query.query}
+        self.assertTrue(_handle(page, 'query', job))
+        self.assertEqual(page.pageid, 8091)
+        self.assertEqual(page.title, 'Douglas_Adams')
+        self.assertEqual(str(page.wikibase), 'Q42')
+        self.assertFalse(_handle(other, 'query', job))
+        self.assertTrue(other.fatal)
+
+    def test_split_wikidata(self):
+        from wptools.batch import _split_wikidata
+        data = wptools.utils.json_loads(wikidata.response)
+        data['entities']['-1'] = {'site': 'enwiki', 'title': 'Nope',
+                                  'missing': ''}
+        by_title = wptools.page('Douglas_Adams', silent=True)
+        by_wikibase = wptools.page(wikibase='Q42', silent=True)
+        missing = wptools.page('Nope', silent=True)
+        self.assertEqual(list(_split_wikidata(by_title, data)['entities']),
+                         ['Q42'])
+        self.assertEqual(
+            list(_split_wikidata(by_wikibase, data)['entities']), ['Q42'])
+        self.assertEqual(list(_split_wikidata(missing, data)['entities']),
+                         ['-1'])
+
+    def test_split_imageinfo(self):
+        from wptools.batch import _split_imageinfo
+        data = wptools.utils.json_loads(imageinfo.response)
+        data['query']['pages'].append({'title': 'File:Other.jpg'})
+        page = wptools.page('test_split_imageinfo', silent=True)
+        page.images = [{'file': 'Douglas_adams_portrait_cropped.jpg'}]
+        pages = _split_imageinfo(page, data)['query']['pages']
+        self.assertEqual(len(pages), 1)
+        self.assertTrue(pages[0]['title'].startswith('File:Douglas'))
+
+
+class WPToolsGetTestCase(FakeMultiTestCase):
+
+    def test_get_rounds(self):
+        page = wptools.page('Douglas_Adams', silent=True).get()
+        rounds = [sorted([x.split('?')[1].split('&')[0] for x in y])
+                  for y in FakeMulti.rounds]
+        self.assertEqual(rounds, [['action=parse', 'action=query'],
+                                  ['action=wbgetentities'],
+                                  ['action=wbgetentities'],
+                                  ['action=query']])
+        self.assertTrue('&ids=Q42&' in FakeMulti.rounds[1][0])
+        self.assertTrue('props=labels' in FakeMulti.rounds[2][0])
+        self.assertTrue('prop=imageinfo' in FakeMulti.rounds[3][0])
+        self.assertEqual(page.label, 'Douglas Adams')
+        self.assertEqual(len(page.infobox), 15)
+
+    def test_get_parse_cache(self):
+        page = wptools.page('Douglas_Adams', silent=True)
+        page.get(fields=['infobox'])
+        parse = [x for y in FakeMulti.rounds for x in y if 'action=parse' in x]
+        self.assertTrue(parse[0].endswith('&section=0'))
+        self.assertEqual((page.cache['parse']['props'],
+                          page.cache['parse']['section']), ('parsetree', 0))
+
+        FakeMulti.rounds = []
+        page.get()
+        parse = [x for y in FakeMulti.rounds for x in y if 'action=parse' in x]
+        self.assertEqual(len(parse), 1)
+        self.assertTrue('&section=' not in parse[0])
+        self.assertEqual(page.cache['parse']['props'], None)
+
+        FakeMulti.rounds = []
+        page.get(fields=['wikitext'])
+        self.assertEqual(FakeMulti.rounds, [])
+
+    def test_get_wikibase_rounds(self):
+        wptools.page(wikibase='Q42', silent=True).get()
+        self.assertTrue('wbgetentities' in FakeMulti.rounds[0][0])
+        self.assertEqual(len(FakeMulti.rounds[1]), 3)  # query, parse, claims
+
+    def test_get_redirect(self):
+        page = wptools.page('douglas adams', silent=True).get()
+        self.assertEqual(page.title, 'Douglas_Adams')
+        self.assertEqual(page.wikibase, 'Q42')
+        self.assertEqual(page.label, 'Douglas Adams')
+
+    def test_get_fields_normalize(self):
+        page = wptools.page('douglas adams', silent=True)
+        page.get(fields=['props'])
+        self.assertEqual(len(FakeMulti.rounds), 1)
+        self.assertTrue('&titles=douglas_adams&normalize=1'
+                        in FakeMulti.rounds[0][0])
+        self.assertEqual(page.wikibase, 'Q42')
+
+    def test_wikidata_retry(self):
+        pages = [wptools.page('douglas adams', silent=True),
+                 wptools.page('Douglas_Adams', silent=True)]
+        wptools.batch.fetch_many(pages, ['wikidata'])
+        self.assertEqual(len(FakeMulti.rounds[0]), 1)
+        self.assertTrue('&normalize=1' not in FakeMulti.rounds[0][0])
+        self.assertEqual(len(FakeMulti.rounds[1]), 2)
+        self.assertEqual([x.wikibase for x in pages], ['Q42', 'Q42'])
+
+    def test_get_missing(self):
+        FakeMulti.missing = True
+        page = wptools.page('test_get_missing', silent=True)
+        self.assertRaises(LookupError, page.get)
+        page = wptools.page('test_get_missing', silent=True)
+        self.assertRaises(LookupError, page.get, fields=['props'])
+        self.assertTrue('&normalize=1' in FakeMulti.rounds[-1][0])
+        pages = [wptools.page('test_get_missing', silent=True)]
+        wptools.batch.fetch_many(pages, ['query', 'wikidata'])
+        self.assertTrue(pages[0].fatal)
+
+    def test_get_pageid(self):
+        page = wptools.page(pageid=8091, silent=True)
+        page.get(fields=['wikidata'])
+        self.assertTrue('&pageids=8091' in FakeMulti.rounds[0][0])
+        self.assertTrue('&ids=Q42&' in FakeMulti.rounds[1][0])
+        self.assertEqual(page.label, 'Douglas Adams')
+        page = wptools.page(pageid=8091, silent=True)
+        self.assertRaises(LookupError, wptools.batch.fetch_many, [page],
+                          ['rest'], strict=True)
+
+    def test_parse_infobox_deferred(self):
+        page = wptools.page('test_parse_infobox_deferred', silent=True)
+        page._set_response('parse', parse.query, parse.response, {})
+        self.assertEqual(page._pending('parse'), ['imageinfo'])
+        self.assertEqual(list(page._deferred), ['infobox'])
+        self.assertEqual(page.images, [])
+
+        pages = [wptools.page('Douglas_Adams', silent=True)]
+        wptools.batch.fetch_many(pages, ['parse'])
+        image = pages[0].image('parse-image')
+        self.assertTrue(image and image['url'])
+        self.assertEqual(pages[0]._deferred, {})
+
+    def test_get_error(self):
+        import pycurl
+        FakeMulti.error = pycurl.error(6, "Could not resolve host")
+        page = wptools.page('test_get_error', silent=True)
+        self.assertRaises(pycurl.error, page.get)
+        pages = [wptools.page('test_get_error', silent=True)]
+        wptools.batch.fetch_many(pages)
+        self.assertTrue(pages[0].fatal)
+
+    def test_claims_shared(self):
+        ids = sorted(json.loads(claims.response)['entities'])
+        pages = [wptools.page('test_claims_shared', silent=True),
+                 wptools.page('test_claims_shared', silent=True),
+                 wptools.page('test_claims_shared', lang='fr', silent=True)]
+        pages[0].claims = dict((x, 'a') for x in ids[:8])
+        pages[1].claims = dict((x, 'b') for x in ids[4:])
+        pages[2].claims = dict((x, 'c') for x in ids[:2])
+        wptools.store.LABELS.set("%s|en" % ids[0], 'label')
+        limit = wptools.fetch.WIKIDATA_LIMIT
+        wptools.fetch.WIKIDATA_LIMIT = 5
+        try:
+            wptools.batch.fetch_many(pages, ['claims'])
+        finally:
+            wptools.fetch.WIKIDATA_LIMIT = limit
+        urls = FakeMulti.rounds[0]
+        self.assertEqual(len(FakeMulti.rounds), 1)
+        self.assertEqual(len(urls), 3)
+        self.assertEqual(sorted("|".join(x.split('&ids=')[1].split('&')[0]
+                                         for x in urls[:2]).split('|')),
+                         ids[1:])
+        self.assertTrue('&languages=fr&' in urls[2])
+        self.assertEqual(sorted(pages[0].cache['claims']['data']['entities']),
+                         ids[1:8])
+        self.assertEqual(sorted(pages[1].cache['claims']['data']['entities']),
+                         ids[4:])
+        self.assertEqual(len(pages[0].wikidata['a']), 8)
+        self.assertEqual(len(pages[1].wikidata['b']), 7)
+
+    def test_imageinfo_shared(self):
+        pages = [wptools.page('test_imageinfo_shared', silent=True)
+                 for _ in range(2)]
+        for page in pages:
+            page.images = [{'file': 'Douglas adams portrait cropped.jpg'}]
+        wptools.batch.fetch_many(pages, ['imageinfo'])
+        self.assertEqual(len(FakeMulti.rounds), 1)
+        self.assertTrue(pages[0].images[0]['url'])
+        self.assertEqual(pages[0].images, pages[1].images)
+        self.assertTrue(pages[0].images[0] is not pages[1].images[0])
+        data = pages[0].cache['imageinfo']['data']
+        self.assertTrue(data is not pages[1].cache['imageinfo']['data'])
+        for item in data['query']['pages']:
+            for info in item['imageinfo']:
+                self.assertTrue('file' not in info)
+
+
+class FakeTransport(object):
+    """
+    aio.transport() stand-in that serves FakeMulti fixtures, recording
+    the URLs requested together (before any completes) as rounds
+    """
+
+    def __init__(self):
+        self.done = True
+
+    def get(self, _fetch, url):
+        if self.done:
+            FakeMulti.rounds.append([])
+            self.done = False
+        FakeMulti.rounds[-1].append(url)
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def resolve():
+            self.done = True
+            future.set_result(FakeMulti().respond(url))
+
+        loop.call_soon(resolve)
+        return future
+
+
+@unittest.skipIf(asyncio is None, "needs asyncio")
+class WPToolsAsyncGetTestCase(FakeMultiTestCase):
+
+    def setUp(self):
+        from wptools import aio
+        super(WPToolsAsyncGetTestCase, self).setUp()
+        self.aio = aio
+        self.transport = aio.transport
+        fake = FakeTransport()
+        aio.transport = lambda: fake
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        super(WPToolsAsyncGetTestCase, self).tearDown()
+        self.aio.transport = self.transport
+        self.loop.close()
+
+    def test_aget_rounds(self):
+        page = wptools.page('Douglas_Adams', silent=True)
+        self.loop.run_until_complete(page.aget(False))
+        rounds = [sorted([x.split('?')[1].split('&')[0] for x in y])
+                  for y in FakeMulti.rounds]
+        self.assertEqual(rounds, [['action=parse', 'action=query'],
+                                  ['action=wbgetentities'],
+                                  ['action=wbgetentities'],
+                                  ['action=query']])
+        self.assertTrue('&ids=Q42&' in FakeMulti.rounds[1][0])
+        self.assertTrue('props=labels' in FakeMulti.rounds[2][0])
+        self.assertTrue('prop=imageinfo' in FakeMulti.rounds[3][0])
+        self.assertEqual(page.label, 'Douglas Adams')
+        self.assertEqual(len(page.infobox), 15)
+        self.assertTrue(page.wikidata.get('instance'))
+        self.assertTrue(page.images[0].get('url'))
+
+    def test_aget_wikibase_rounds(self):
+        page = wptools.page(wikibase='Q42', silent=True)
+        self.loop.run_until_complete(page.aget(False))
+        self.assertTrue('wbgetentities' in FakeMulti.rounds[0][0])
+        self.assertEqual(len(FakeMulti.rounds[1]), 3)  # query, parse, claims
+        self.assertEqual(page.title, 'Douglas_Adams')
+
+    def test_aget_redirect(self):
+        page = wptools.page('douglas adams', silent=True)
+        self.loop.run_until_complete(page.aget(False))
+        self.assertEqual(page.title, 'Douglas_Adams')
+        self.assertEqual(page.wikibase, 'Q42')
+
+    def test_aget_missing(self):
+        FakeMulti.missing = True
+        page = wptools.page('test_aget_missing', silent=True)
+        self.assertRaises(LookupError, self.loop.run_until_complete,
+                          page.aget(False))
+
+    def test_aget_claims(self):
+        page = wptools.page('Douglas_Adams', silent=True)
+        self.loop.run_until_complete(page.aget_wikidata(False))
+        self.assertTrue('props=labels' in FakeMulti.rounds[1][0])
+        self.assertTrue(page.wikidata.get('instance'))
+
+
 class WPToolsFetchTestCase(unittest.TestCase):
 
+    def test_curl_pool(self):
+        pool = wptools.fetch.CurlPool(maxidle=1)
+        f = wptools.fetch.WPToolsFetch()
+        key = f.pool_key('https://en.wikipedia.org/w/api.php')
+        first = pool.acquire(key, f.curl_setup)
+        second = pool.acquire(key, f.curl_setup)
+        pool.release(key, first)
+        pool.release(key, second)
+        self.assertTrue(pool.acquire(key, f.curl_setup) is first)
+        self.assertEqual(pool.stats['borrowed'], 3)
+        self.assertEqual(pool.stats['created'], 2)
+        self.assertEqual(pool.stats['closed'], 1)
+
+    def test_multi(self):
+        import os
+        import tempfile
+        fd, path = tempfile.mkstemp()
+        os.write(fd, query.response.encode('utf-8'))
+        os.close(fd)
+        multi = wptools.fetch.WPToolsMulti(maxhost=2)
+        for _ in range(3):
+            _fetch = wptools.fetch.WPToolsFetch(silent=True)
+            multi.add(_fetch, 'file://' + path)
+        jobs = multi.perform()
+        os.remove(path)
+        self.assertEqual(len(jobs), 3)
+        for job in jobs:
+            self.assertTrue(job['error'] is None)
+            self.assertTrue(b'Douglas Adams' in job['response'])
+            self.assertEqual(job['info']['bytes-decoded'],
+                             len(job['response']))
+
+    def test_multi_keepalive(self):
+        server, url = serve([(200, {}, b'{}')])
+        pool = wptools.fetch.POOL
+        stats = dict(pool.stats)
+        try:
+            for _ in range(3):
+                multi = wptools.fetch.WPToolsMulti()
+                multi.add(wptools.fetch.WPToolsFetch(silent=True), url)
+                self.assertEqual(multi.perform()[0]['response'], b'{}')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(pool.stats['connects'] - stats['connects'], 1)
+        self.assertEqual(pool.stats['reused'] - stats['reused'], 2)
+
+    def test_retry(self):
+        import os
+        import tempfile
+        maxlag = (200, {'MediaWiki-API-Error': 'maxlag'}, b'{"error": 1}')
+        server, url = serve([(503, {}, b''), (200, {}, b'a'),
+                             (429, {'Retry-After': '0'}, b''),
+                             (200, {}, b'b'), maxlag])
+        saved = (wptools.fetch.THROTTLE, wptools.store.RESPONSES)
+        path = tempfile.mktemp()
+        throttle = wptools.fetch.Throttle(retries=2, backoff=0.01)
+        wptools.fetch.THROTTLE = throttle
+        wptools.store.RESPONSES = wptools.store.ResponseCache(path)
+        try:
+            _fetch = wptools.fetch.WPToolsFetch(silent=True)
+            _fetch.action = 'query'
+            self.assertEqual(_fetch.curl(url + 'a'), b'a')
+            self.assertEqual(_fetch.info['retries'], 1)
+            self.assertTrue(wptools.store.RESPONSES.get(url + 'a', 'query'))
+
+            multi = wptools.fetch.WPToolsMulti()
+            job = multi.add(_fetch, url + 'b')
+            multi.perform()
+            self.assertEqual((job['response'], job['info']['retries']),
+                             (b'b', 1))
+
+            self.assertEqual(_fetch.curl(url + 'c'), maxlag[2])
+            self.assertEqual(_fetch.info['retries'], 2)
+            self.assertTrue(
+                wptools.store.RESPONSES.get(url + 'c', 'query') is None)
+            self.assertEqual(throttle.stats['retries'], 4)
+        finally:
+            wptools.fetch.THROTTLE, wptools.store.RESPONSES = saved
+            server.shutdown()
+            server.server_close()
+            os.remove(path)
+
+    @unittest.skipIf(asyncio is None, "needs asyncio")
+    def test_async_transport(self):
+        import os
+        import tempfile
+        from wptools import aio
+        fd, path = tempfile.mkstemp()
+        os.write(fd, query.response.encode('utf-8'))
+        os.close(fd)
+        loop = asyncio.new_event_loop()
+        _fetch = wptools.fetch.WPToolsFetch(silent=True)
+        future = aio.transport(loop).get(_fetch, 'file://' + path)
+        body = loop.run_until_complete(future)
+        loop.close()
+        os.remove(path)
+        self.assertTrue(b'Douglas Adams' in body)
+        self.assertEqual(_fetch.info['status'], 0)
+
+    @unittest.skipIf(asyncio is None, "needs asyncio")
+    def test_async_maxhost(self):
+        import gc
+        from wptools import aio
+        server, url = serve([(200, {}, b'{}')])
+        pool = wptools.fetch.POOL
+        stats = dict(pool.stats)
+        loop = asyncio.new_event_loop()
+        try:
+            multi = aio.AsyncMulti(loop, maxhost=2)
+            futures = [multi.get(wptools.fetch.WPToolsFetch(silent=True),
+                                 url + str(x)) for x in range(8)]
+            bodies = loop.run_until_complete(asyncio.gather(*futures))
+        finally:
+            loop.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(bodies, [b'{}'] * 8)
+        self.assertEqual(pool.stats['connects'] - stats['connects'], 2)
+
+        count = len(aio.TRANSPORTS)
+        del loop, multi, futures
+        for _ in range(3):
+            loop = asyncio.new_event_loop()
+            aio.transport(loop)
+            loop.close()
+        del loop
+        gc.collect()
+        self.assertEqual(len(aio.TRANSPORTS), count)
+
+    @unittest.skipIf(asyncio is None, "needs asyncio")
+    def test_async_random_title(self):
+        from wptools import aio
+        calls = []
+        response = json.dumps({'query': {'random': [{'id': 1,
+                                                     'title': 'A b'}]}})
+
+        class Transport(object):
+            def get(self, _fetch, url):
+                calls.append((url, _fetch.proxy, _fetch.timeout))
+                future = asyncio.get_event_loop().create_future()
+                future.set_result(response)
+                return future
+
+        pool, transport = wptools.store.RANDOM, aio.transport
+        wptools.store.RANDOM = wptools.store.RandomPool(lowat=0)
+        aio.transport = Transport
+        loop = asyncio.new_event_loop()
+        try:
+            page = wptools.page(lazy=True, silent=True)
+            loop.run_until_complete(aio.random_title(page, 'proxy:1', 5))
+        finally:
+            wptools.store.RANDOM, aio.transport = pool, transport
+            loop.close()
+        self.assertEqual((page.pageid, page.title), (1, 'A_b'))
+        self.assertEqual(len(calls), 1)
+        self.assertTrue('&list=random&' in calls[0][0])
+        self.assertEqual(calls[0][1:], ('proxy:1', 5))
+
+    def test_random_pool(self):
+        pool = wptools.store.RandomPool(lowat=2)
+        batches = [[(1, 'A'), (2, 'B'), (3, 'C')], [(4, 'D')]]
+        self.assertEqual(pool.get('en', lambda: batches.pop(0)), (1, 'A'))
+        self.assertEqual(pool.get('en', lambda: batches.pop(0)), (2, 'B'))
+        for _ in range(100):
+            if not pool.refilling:
+                break
+            time.sleep(0.01)
+        self.assertEqual(list(pool.pools['en']), [(3, 'C'), (4, 'D')])
+        self.assertEqual(pool.stats, {'hits': 1, 'misses': 1, 'refills': 2})
+        self.assertEqual(pool.get('fr', lambda: []), None)
+
+    def test_throttle(self):
+        now = [1000.0]
+        throttle = wptools.fetch.Throttle(rate=10, burst=2, backoff=1,
+                                          clock=lambda: now[0])
+        self.assertEqual(throttle.acquire('a'), 0)
+        self.assertEqual(throttle.acquire('a'), 0)
+        self.assertAlmostEqual(throttle.acquire('a'), 0.1)
+        now[0] += 0.1
+        self.assertAlmostEqual(throttle.acquire('a'), 0.1)
+        self.assertEqual(throttle.acquire('b'), 0)
+
+        self.assertFalse(throttle.retry('b', 0, {'status': 404}, {}))
+        self.assertFalse(throttle.retry('b', 3, {'status': 503}, {}))
+        self.assertTrue(throttle.retry(
+            'b', 0, {'status': 200}, {'mediawiki-api-error': 'maxlag',
+                                      'retry-after': '5'}))
+        self.assertEqual(throttle.acquire('b'), 5)
+        self.assertTrue(2 <= throttle.delay(2, {}) <= 4)
+        self.assertEqual(throttle.stats, {'retries': 1, 'throttled': 3})
+
+        _fetch = wptools.fetch.WPToolsFetch(lang='en')
+        maxlag = wptools.fetch.THROTTLE.maxlag
+        wptools.fetch.THROTTLE.maxlag = 5
+        try:
+            self.assertTrue(_fetch.query('query', 'x').endswith('&maxlag=5'))
+            self.assertFalse('maxlag' in _fetch.query('/page/html/', 'x'))
+        finally:
+            wptools.fetch.THROTTLE.maxlag = maxlag
+
+    def test_response_cache(self):
+        import os
+        import tempfile
+        from wptools.store import ResponseCache
+        path = tempfile.mktemp()
+        cache = ResponseCache(path, ttl={'parse': 60}, maxbytes=8)
+        info = {'status': 200}
+        cache.put('a', 'parse', b'12345', info, 'en|A')
+        cache.put('b', 'random', b'12345', info, 'en|A')
+        self.assertEqual(cache.get('a', 'parse')['body'], b'12345')
+        self.assertTrue(cache.get('b', 'random') is None)
+        cache.invalidate('en|A', '2000-01-01T00:00:00Z')
+        self.assertTrue(cache.get('a', 'parse') is not None)
+        cache.put('c', 'parse', b'12345', info, 'en|C')
+        self.assertTrue(cache.get('a', 'parse') is None)
+        cache.invalidate('en|C', '2100-01-01T00:00:00Z')
+        self.assertTrue(cache.get('c', 'parse') is None)
+        os.remove(path)
+
+    def test_revalidate(self):
+        import os
+        import tempfile
+        from wptools.store import ResponseCache
+        responses = wptools.store.RESPONSES
+        path = tempfile.mktemp()
+        wptools.store.RESPONSES = ResponseCache(path)
+        try:
+            f = wptools.fetch.WPToolsFetch(silent=True)
+            f.query('parse', 'a')
+            url = 'https://en.wikipedia.org/a'
+            info = {'status': 200, 'etag': '"a"'}
+            wptools.store.RESPONSES.put(url, 'parse', b'a', info)
+            self.assertEqual(f.cached(url), b'a')
+            wptools.store.RESPONSES.ttl['parse'] = -1
+            self.assertTrue(f.cached(url) is None)
+            self.assertEqual(f.stale['body'], b'a')
+            f.curl_header(b'HTTP/1.1 304 Not Modified\r\n')
+            f.curl_header(b'ETag: "a"\r\n')
+            self.assertEqual(f.headers['etag'], '"a"')
+
+            server, url = serve([(304, {'ETag': '"b"'}, b'')])
+            info = {'status': 200, 'etag': '"a"', 'bytes': 1}
+            wptools.store.RESPONSES.put(url, 'parse', b'a', info)
+            try:
+                self.assertEqual(f.curl(url), b'a')
+            finally:
+                server.shutdown()
+                server.server_close()
+            self.assertEqual((f.info['status'], f.info['revalidated']),
+                             (304, True))
+            entry = wptools.store.RESPONSES.get(url, 'parse', stale=True)
+            self.assertEqual(entry['info'], {'status': 200, 'etag': '"b"',
+                                             'bytes': 1})
+        finally:
+            wptools.store.RESPONSES = responses
+            os.remove(path)
+
     def test_variant(self):
         f = wptools.fetch.WPToolsFetch(variant='zh-cn')
         self.assertTrue(f.query('query', 'a').endswith('&variant=zh-cn'))
@@ -175,6 +1023,59 @@ class WPToolsUtilsTestCase(unittest.TestCase):
         ans = "a<span><span ignored></span>c</span>"
         self.assertEqual(snip_html(txt), ans)
 
+    def test_snip_html_descendants(self):
+        from wptools.utils import snip_html
+        txt = ("<p>a<sup class=\"reference\">1</sup>b<i>c<sup "
+               "class=\"noprint x\">2</sup>d</i><style>e</style>f</p>"
+               "<b class=\"metadata\"><i class=\"haudio\">g</i></b>h")
+        ans = ("<span><p>a<span removed></span>b<i>c<span removed></span>"
+               "d</i><style>e</style>f</p><span ignored></span>h</span>")
+        self.assertEqual(snip_html(txt), ans)
+        ans = ("<span><p>a<sup class=\"reference\">1</sup>b<i>c"
+               "<span removed></span>d</i><span removed></span>f</p>"
+               "<b class=\"metadata\"><i class=\"haudio\">g</i></b>h</span>")
+        self.assertEqual(snip_html(txt, classes=['noprint'],
+                                   tags=['style']), ans)
+
+    def test_get_infobox(self):
+        from wptools.utils import get_infobox
+        ptree = ("<root><template><title>Other</title></template>"
+                 "<template><title>Infobox person</title><part>"
+                 "<name>name</name><equals>=</equals><value>A</value>"
+                 "</part></template><template><title>Taxobox</title>"
+                 "</template><broken></root>")
+        self.assertEqual(get_infobox(ptree), {'name': 'A'})
+        self.assertEqual(get_infobox(u"<root>\u00e9</root>"), None)
+
+    def test_get_wikitext_infobox(self):
+        from wptools.utils import get_infobox, get_wikitext_infobox
+        pdata = json.loads(parse.response)['parse']
+        self.assertEqual(get_wikitext_infobox(pdata['wikitext']),
+                         get_infobox(pdata['parsetree']))
+        text = ("{{Other|box=x}} [[File:a|b]] {{Infobox person <!-- c -->\n"
+                "| name = A<ref name=r>{{cite|x=1}}</ref>\n"
+                "| birth = {{dob|1952|3|df=yes}} <!-- d -->\n"
+                "| image = [[File:b.jpg|thumb]]\n| empty =\n| 3\n}}")
+        self.assertEqual(get_wikitext_infobox(text), {
+            'birth': '{{dob|1952|3|df|=|yes}}',
+            'image': '[[File:b.jpg|thumb]]',
+            'name': 'A<ref name=r>{{cite|x=1}}</ref>',
+            'empty': ''})
+        self.assertEqual(get_wikitext_infobox("{{Infobox x"), None)
+
+    def test_media_url(self):
+        from wptools.utils import media_url, thumb_url
+        url = media_url('File:Douglas adams portrait cropped.jpg')
+        self.assertTrue(url.endswith('/commons/c/c0/'
+                                     'Douglas_adams_portrait_cropped.jpg'))
+        self.assertEqual(media_url('Douglas_adams_portrait_cropped.jpg'),
+                         url)
+        self.assertTrue(thumb_url(url, 220).endswith(
+            '/commons/thumb/c/c0/Douglas_adams_portrait_cropped.jpg/'
+            '220px-Douglas_adams_portrait_cropped.jpg'))
+        self.assertTrue(thumb_url(media_url('Flag.svg'), 40).endswith(
+            '/Flag.svg/40px-Flag.svg.png'))
+
 
 if __name__ == '__main__':
     unittest.main()
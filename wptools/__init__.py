@@ -20,7 +20,11 @@ __license__ = "MIT"
 __title__ = "wptools"
 __version__ = "0.2.3"
 
+from . import batch
 from . import fetch
+from . import store
 from . import utils
 
+from .batch import fetch_many
+from .batch import fetch_random
 from .core import WPTools as page
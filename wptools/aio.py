@@ -0,0 +1,310 @@
+# -*- coding:utf-8 -*-
+
+"""
+WPTools asyncio module.
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Non-blocking requests driven by pycurl.CurlMulti socket callbacks on an
+asyncio event loop (python 3.5+). Use the WPTools.aget_* methods:
+
+    >>> page = await wptools.page('Gandhi', silent=True).aget()
+"""
+
+import asyncio
+import weakref
+
+import pycurl
+
+from . import batch
+from . import fetch
+from . import store
+from . import utils
+from .fetch import POOL
+
+TRANSPORTS = weakref.WeakKeyDictionary()
+
+
+class AsyncMulti(object):
+    """
+    pycurl.CurlMulti transport that never blocks the event loop,
+    at most maxhost connections per host (more transfers wait)
+
+    Holds its loop by weak reference only, so it goes (with its
+    connections) when the loop does.
+    """
+
+    def __init__(self, loop, maxhost=6):
+        self.jobs = {}
+        self.timer = None
+        self._loop = weakref.ref(loop)
+
+        self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, maxhost)
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self._socket)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self._timer)
+
+    @property
+    def loop(self):
+        """
+        returns event loop of transport
+        """
+        return self._loop()
+
+    def _action(self, sock, events):
+        """
+        tell curl about socket activity (or timeout), then reap
+        """
+        while True:
+            ret, _ = self.multi.socket_action(sock, events)
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        self._reap()
+
+    def _add(self, job):
+        """
+        start transfer of job
+        """
+        _fetch = job['fetch']
+        crl = POOL.acquire(job['key'], _fetch.curl_setup)
+        job['buffer'] = _fetch.curl_prepare(crl, job['url'])
+
+        self.jobs[crl] = job
+        self.multi.add_handle(crl)
+        self.loop.call_soon(self._action, pycurl.SOCKET_TIMEOUT, 0)
+
+    def _finish(self, crl, error=None):
+        """
+        release handle and resolve its future (or retry)
+        """
+        self.multi.remove_handle(crl)
+        job = self.jobs.pop(crl)
+        future = job['future']
+        _fetch = job['fetch']
+
+        if error:
+            job['buffer'].close()
+            POOL.release(job['key'], crl, discard=True)
+            if not future.done():
+                future.set_exception(error)
+            return
+
+        body = _fetch.curl_finish(crl, job['buffer'])
+        POOL.release(job['key'], crl)
+
+        if _fetch.retry(job['url'], job['retries']):
+            job['retries'] += 1
+            self._start(job)
+            return
+
+        _fetch.throttle_info(job['retries'], job['waited'])
+        _fetch.cache_response(job['url'], body)
+        if not future.done():
+            future.set_result(body)
+
+    def _reap(self):
+        """
+        finish completed transfers
+        """
+        while True:
+            queued, done, failed = self.multi.info_read()
+            for crl in done:
+                self._finish(crl)
+            for crl, errno, errmsg in failed:
+                self._finish(crl, pycurl.error(errno, errmsg))
+            if not queued:
+                break
+
+    def _start(self, job):
+        """
+        start job now, or when fetch.THROTTLE allows
+        """
+        wait = fetch.THROTTLE.acquire(job['key'][0])
+        if wait > 0:
+            job['waited'] += wait
+            self.loop.call_later(wait, self._add, job)
+        else:
+            self._add(job)
+
+    def _socket(self, event, sock, multi, data):
+        """
+        M_SOCKETFUNCTION: watch sockets curl asks us to watch
+        """
+        if event == pycurl.POLL_REMOVE or event == pycurl.POLL_OUT:
+            self.loop.remove_reader(sock)
+        if event == pycurl.POLL_REMOVE or event == pycurl.POLL_IN:
+            self.loop.remove_writer(sock)
+
+        if event == pycurl.POLL_IN or event == pycurl.POLL_INOUT:
+            self.loop.add_reader(sock, self._action, sock, pycurl.CSELECT_IN)
+        if event == pycurl.POLL_OUT or event == pycurl.POLL_INOUT:
+            self.loop.add_writer(sock, self._action, sock, pycurl.CSELECT_OUT)
+
+    def _timer(self, msecs):
+        """
+        M_TIMERFUNCTION: call curl back after msecs (-1 = cancel)
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if msecs >= 0:
+            self.timer = self.loop.call_later(msecs / 1000.0, self._timeout)
+
+    def _timeout(self):
+        """
+        timer fired: drop it (it holds the loop), then tell curl
+        """
+        self.timer = None
+        self._action(pycurl.SOCKET_TIMEOUT, 0)
+
+    def get(self, _fetch, url):
+        """
+        returns future for body of GET url with WPToolsFetch settings
+        """
+        future = self.loop.create_future()
+
+        body = _fetch.cached(url)
+        if body is not None:
+            future.set_result(body)
+            return future
+
+        self._start({'fetch': _fetch,
+                     'future': future,
+                     'key': _fetch.pool_key(url),
+                     'retries': 0,
+                     'url': url,
+                     'waited': 0})
+
+        return future
+
+
+def _apply(page, action, requests, responses):
+    """
+    set page data from responses to action requests
+    """
+    _fetch, query = requests[0]
+    if len(responses) > 1:
+        page._set_response(action, query, None, _fetch.info,
+                           page._merge_responses(responses))
+    else:
+        page._set_response(action, query, responses[0], _fetch.info)
+
+
+async def _responses(page, action, proxy, timeout):
+    """
+    returns (requests, responses) for action, made concurrently
+    """
+    requests = page._queries(action, proxy, timeout)
+    responses = await asyncio.gather(
+        *[transport().get(_fetch, query) for _fetch, query in requests])
+    return requests, responses
+
+
+def transport(loop=None):
+    """
+    returns the AsyncMulti transport for loop (default: current loop)
+    """
+    loop = loop or asyncio.get_event_loop()
+    if loop not in TRANSPORTS:
+        TRANSPORTS[loop] = AsyncMulti(loop)
+    return TRANSPORTS[loop]
+
+
+async def get(page, show=True, proxy=None, timeout=0):
+    """
+    awaitable WPTools.get(), in the rounds of batch.fetch_many(): all
+    ready actions at once (wikidata by title after query), then claims,
+    then one imageinfo for images still missing info
+    """
+    if page._untitled():
+        await random_title(page, proxy, timeout)
+
+    if page.wikibase and not page.title:
+        actions = ['wikidata', 'query', 'parse']
+    else:
+        actions = ['query', 'parse', 'wikidata']
+
+    todo = [(page, action) for action in actions]
+    retried = []
+    while todo:
+        ready = [x for x in todo if page._ready(x[1], proxy, timeout)
+                 and not batch._waits(page, x[1], todo)]
+
+        if not ready:
+            for _, action in todo:
+                utils.stderr("%s not ready for %s" % (page.title, action),
+                             page.silent)
+            break
+
+        todo = [x for x in todo if x not in ready]
+        ready = [x for x in ready if not page._skip(x[1])]
+
+        results = await asyncio.gather(
+            *[_responses(page, action, proxy, timeout) for _, action in ready])
+
+        for (_, action), (requests, responses) in zip(ready, results):
+            try:
+                _apply(page, action, requests, responses)
+            except LookupError:
+                job = {'url': requests[0][1]}
+                if (page, action) in retried or not batch._retry_wikidata(
+                        page, action, job):
+                    raise
+                page.cache.pop(action, None)
+                retried.append((page, action))
+                todo.append((page, action))
+                continue
+            for pending in page._pending(action):
+                if pending != 'imageinfo' and (page, pending) not in todo:
+                    todo.append((page, pending))
+
+    if page._missing_imageinfo():
+        await request(page, 'imageinfo', False, proxy, timeout)
+
+    if show:
+        page.show()
+
+    return page
+
+
+async def random_title(page, proxy=None, timeout=0):
+    """
+    awaitable WPTools._set_random_title(), refilling an empty
+    store.RANDOM pool through the transport
+    """
+    key = (page.lang, page.wiki, 0)
+    if not store.RANDOM.count(key):
+        _fetch, query = page._random_query(0, proxy, timeout)
+        response = await transport().get(_fetch, query)
+        titles = page._random_titles(query, response)
+        store.RANDOM.refill(key, lambda: titles)
+    page._set_random_title(0, proxy, timeout)
+
+
+async def request(page, action, show=True, proxy=None, timeout=0):
+    """
+    awaitable WPTools._request(), returns page
+    """
+    if page._untitled():
+        await random_title(page, proxy, timeout)
+
+    if not page._ready(action, proxy, timeout):
+        raise LookupError("aget_%s needs more page attributes" % action)
+
+    if action == 'imageinfo' and not page._missing_imageinfo():
+        return page
+
+    if page._skip(action):
+        return page
+
+    requests, responses = await _responses(page, action, proxy, timeout)
+    _apply(page, action, requests, responses)
+
+    for pending in page._pending(action):
+        if pending == 'imageinfo' and not page._missing_imageinfo():
+            continue
+        await request(page, pending, False, proxy, timeout)
+
+    if show:
+        page.show()
+
+    return page
@@ -0,0 +1,483 @@
+# -*- coding:utf-8 -*-
+
+"""
+WPTools Batch module.
+~~~~~~~~~~~~~~~~~~~~~
+
+Populate many pages at once with concurrent requests.
+"""
+
+try:  # python2
+    from urllib import quote
+except ImportError:  # python3
+    from urllib.parse import quote
+
+from collections import OrderedDict
+
+from . import fetch
+from . import utils
+
+
+def _batch_key(page, action):
+    """
+    returns key of pages that can share a request for action, or None
+    """
+    if action == 'claims':
+        return (action, page.variant or page.lang)
+    if action == 'query':
+        return (action, page.lang, page.wiki, page.variant, bool(page.pageid))
+    if action == 'wikidata':
+        if page.wikibase:
+            return (action, page.variant or page.lang)
+        return (action, page.variant or page.lang, "%swiki" % page.lang)
+
+
+def _chunks(items, size):
+    """
+    returns list of items in lists of at most size
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _claims_many(pages, multi, proxy, timeout):
+    """
+    add wbgetentities for Q-ids missing labels in pages (same lang) to
+    multi, fetch.WIKIDATA_LIMIT distinct ids at a time, returns jobs
+    """
+    ids = []
+    for page in pages:
+        ids.extend([x for x in page.claims
+                    if x not in page._labeled and x not in ids])
+
+    jobs = []
+    for chunk in _chunks(ids, fetch.WIKIDATA_LIMIT):
+        _fetch = pages[0]._fetch(proxy, timeout)
+        jobs.append(multi.add(_fetch, pages[0]._query('claims', _fetch,
+                                                      chunk)))
+    return jobs
+
+
+def _combine(jobs, pages, split):
+    """
+    returns one job for pages from chunk jobs they share, merged if
+    more than one, to split per page if more than one page
+    """
+    job = dict(jobs[0])
+    job['error'] = next((x['error'] for x in jobs if x['error']), None)
+    if not job['error'] and len(jobs) > 1:
+        job['response'] = None
+        job['data'] = pages[0]._merge_responses([x['response'] for x in jobs])
+    if len(pages) > 1:
+        job['split'] = split
+    return job
+
+
+def _handle(page, action, job, strict=False, retry=None):
+    """
+    set page data from finished job (or list of chunk jobs),
+    returns True if handled, or appends (page, action) to retry list
+    if it should be retried. If strict, raises the job's pycurl.error,
+    or LookupError if the page was not found.
+    """
+    jobs = job if isinstance(job, list) else [job]
+    for job in jobs:
+        if job['error']:
+            if strict:
+                raise job['error']
+            page.fatal = True
+            utils.stderr("%s failed: %s %s" % (action, job['url'],
+                                               job['error']), page.silent)
+            return False
+
+    try:
+        job = jobs[0]
+        response = job['response']
+        data = job.get('data')
+        if len(jobs) > 1:
+            response = None
+            data = page._merge_responses([x['response'] for x in jobs])
+        if job.get('split'):
+            if data is None:
+                data = job['data'] = utils.json_loads(response)
+            data = job['split'](page, data)
+        page._set_response(action, job['url'], response, job['info'], data)
+        return True
+    except LookupError as detail:
+        if retry is not None and _retry_wikidata(page, action, job):
+            page.cache.pop(action, None)
+            retry.append((page, action))
+            return False
+        if strict:
+            raise
+        page.fatal = True
+        utils.stderr("%s failed: %s" % (action, detail), page.silent)
+    return False
+
+
+def _imageinfo_many(pages, proxy, timeout, maxhost, strict=False):
+    """
+    resolve images missing info for all pages at once: one
+    action=query per fetch.IMAGEINFO_LIMIT distinct files (per wiki),
+    shared by every page with those files
+    """
+    groups = OrderedDict()
+    for page in pages:
+        if page.fatal or not page._ready('imageinfo'):
+            continue
+        if page._skip('imageinfo') or not page._missing_imageinfo():
+            continue
+        key = (page.lang, page.wiki)
+        groups.setdefault(key, []).append(page)
+
+    multi = fetch.WPToolsMulti(maxhost)
+
+    jobs = {}
+    for key in groups:
+        files = []
+        for page in groups[key]:
+            files.extend([x for x in page._imageinfo_files()
+                          if x not in files])
+        jobs[key] = []
+        for chunk in _chunks(files, fetch.IMAGEINFO_LIMIT):
+            _fetch = groups[key][0]._fetch(proxy, timeout)
+            query = groups[key][0]._query('imageinfo', _fetch, chunk)
+            jobs[key].append(multi.add(_fetch, query))
+
+    multi.perform()
+
+    for key in groups:
+        job = _combine(jobs[key], groups[key], _split_imageinfo)
+        for page in groups[key]:
+            _handle(page, 'imageinfo', job, strict)
+
+
+def _perform(todo, proxy, timeout, maxhost, strict=False, single=()):
+    """
+    make (page, action) requests concurrently, returns lists of
+    (page, action) handled, in todo order, and to retry
+    - single: (page, action) not to batch with other pages
+    """
+    multi = fetch.WPToolsMulti(maxhost)
+
+    jobs = {}
+    shared = OrderedDict()
+    groups = OrderedDict()
+    for page, action in todo:
+        if page.fatal or page._skip(action):
+            continue
+        key = None
+        if (page, action) not in single:
+            key = _batch_key(page, action)
+        if key:
+            groups.setdefault(key, []).append(page)
+            continue
+        requests = page._queries(action, proxy, timeout)
+        if len(requests) == 1:
+            jobs[(id(page), action)] = multi.add(*requests[0])
+        else:
+            jobs[(id(page), action)] = [multi.add(*x) for x in requests]
+
+    for key in groups:
+        action = key[0]
+        if action == 'claims':
+            shared[key] = _claims_many(groups[key], multi, proxy, timeout)
+            continue
+        limit, query_many, split = BATCH[action]
+        for chunk in _chunks(groups[key], limit):
+            _fetch = chunk[0]._fetch(proxy, timeout)
+            if len(chunk) == 1:
+                job = multi.add(_fetch, chunk[0]._query(action, _fetch))
+            else:
+                job = multi.add(_fetch, query_many(chunk, _fetch))
+                job['split'] = split
+            for page in chunk:
+                jobs[(id(page), action)] = job
+
+    multi.perform()
+
+    for key in shared:
+        job = _combine(shared[key], groups[key], _split_claims)
+        for page in groups[key]:
+            jobs[(id(page), 'claims')] = job
+
+    handled = []
+    retry = []
+    for page, action in todo:
+        job = jobs.get((id(page), action))
+        if not job or page.fatal:
+            continue
+        again = None if (page, action) in single else retry
+        if _handle(page, action, job, strict, again):
+            handled.append((page, action))
+
+    return handled, retry
+
+
+def _retry_wikidata(page, action, job):
+    """
+    returns True if a wikidata lookup by title missed, but could find
+    the item by id (wikibase now known) or by normalized title (one
+    title at a time)
+    """
+    if action != 'wikidata' or isinstance(job, list):
+        return False
+    if '&ids=&' not in job['url']:
+        return False
+    return bool(page.wikibase) or '&normalize=1' not in job['url']
+
+
+def _query_many(pages, _fetch):
+    """
+    returns action=query for many pages (same lang and wiki)
+    """
+    if pages[0].pageid:
+        return _fetch.query('query', "|".join([str(x.pageid) for x in pages]),
+                            pageid=True)
+
+    return _fetch.query('query', _titles(pages))
+
+
+def _split_claims(page, data):
+    """
+    returns multi-page wbgetentities (labels) data for page claims
+    (without labels yet) only
+    """
+    entities = data.get('entities', {})
+
+    mine = {}
+    for key in entities:
+        if key in page.claims and key not in page._labeled:
+            mine[key] = entities[key]
+
+    return {'entities': mine}
+
+
+def _split_imageinfo(page, data):
+    """
+    returns multi-file imageinfo data for page files only
+    """
+    files = page._imageinfo_files()
+
+    pages = []
+    for item in data.get('query', {}).get('pages', []):
+        if utils.file_title(item.get('title', '')) in files:
+            pages.append(item)
+
+    return {'query': {'pages': pages}}
+
+
+def _split_query(page, data):
+    """
+    returns multi-page action=query data for page only
+
+    Follows normalized, converted (variant) and redirects mappings from
+    the title we sent to the title in pages.
+    """
+    data = data.get('query', {})
+
+    query = {'pages': []}
+    if data.get('random'):
+        query['random'] = data['random']
+
+    if page.pageid:
+        query['pages'] = [x for x in data.get('pages', [])
+                          if x.get('pageid') == int(page.pageid)]
+    else:
+        title = page.title
+        for mapping in ['normalized', 'converted', 'redirects']:
+            for item in data.get(mapping, []):
+                if item.get('from') in [title, title.replace('_', ' ')]:
+                    query.setdefault(mapping, []).append(item)
+                    title = item['to']
+        query['pages'] = [x for x in data.get('pages', [])
+                          if x.get('title') == title.replace('_', ' ')]
+
+    return {'query': query}
+
+
+def _split_wikidata(page, data):
+    """
+    returns multi-entity action=wbgetentities data for page only
+
+    Matches by id (or redirect) for wikibase pages, and by sitelink
+    title for pages looked up by lang and title.
+    """
+    entities = data.get('entities', {})
+
+    if page.wikibase:
+        for key in entities:
+            item = entities[key]
+            redirect = item.get('redirects', {}).get('from')
+            if page.wikibase in [key, item.get('id'), redirect]:
+                return {'entities': {key: item}}
+    else:
+        site = "%swiki" % page.lang
+        title = page.title.replace('_', ' ')
+        for key in entities:
+            item = entities[key]
+            if item.get('missing') is not None:
+                if item.get('title', '').replace('_', ' ') == title:
+                    return {'entities': {'-1': item}}
+                continue
+            link = item.get('sitelinks', {}).get(site, {})
+            if link.get('title') == title:
+                return {'entities': {key: item}}
+
+    return {'entities': {'-1': {}}}
+
+
+def _titles(pages):
+    """
+    returns pipe-separated, quoted page titles
+    """
+    titles = []
+    for page in pages:
+        try:
+            titles.append(quote(page.title))
+        except KeyError:
+            titles.append(quote(page.title.encode('utf-8')))
+    return "|".join(titles)
+
+
+def _waits(page, action, todo):
+    """
+    returns True if (page, action) should wait for another in todo:
+    wikidata by title waits for query to find the wikibase
+    """
+    return (action == 'wikidata' and not page.wikibase
+            and (page, 'query') in todo)
+
+
+def _wikidata_many(pages, _fetch):
+    """
+    returns action=wbgetentities for many pages (same lang)
+    """
+    if pages[0].wikibase:
+        ids = "|".join([x.wikibase for x in pages])
+        return _fetch.query('wikidata', {'id': ids})
+
+    return _fetch.query('wikidata', {'site': "%swiki" % pages[0].lang,
+                                     'title': _titles(pages)})
+
+
+BATCH = {'query': (fetch.QUERY_LIMIT, _query_many, _split_query),
+         'wikidata': (fetch.WIKIDATA_LIMIT, _wikidata_many, _split_wikidata)}
+
+
+def fetch_random(count, show=False, proxy=None, timeout=0, maxhost=6,
+                 **kwargs):
+    """
+    returns count random pages with get_query() data, from
+    action=query&generator=random requests for fetch.QUERY_LIMIT pages
+    at a time (made concurrently)
+    - kwargs: wptools.page() options, e.g. lang, silent, wiki
+    """
+    from .core import WPTools
+
+    pages = []
+    pageids = set()
+    while len(pages) < count:
+        need = count - len(pages)
+        multi = fetch.WPToolsMulti(maxhost)
+        for i in range(0, need, fetch.QUERY_LIMIT):
+            _fetch = fetch.WPToolsFetch(
+                lang=kwargs.get('lang') or 'en',
+                silent=kwargs.get('silent'),
+                variant=kwargs.get('variant'),
+                verbose=kwargs.get('verbose'),
+                wiki=kwargs.get('wiki'),
+                proxy=proxy,
+                timeout=timeout)
+            multi.add(_fetch, _fetch.query(
+                'random', min(fetch.QUERY_LIMIT, need - i)))
+
+        for job in multi.perform():
+            if job['error']:
+                raise LookupError("%s %s" % (job['url'], job['error']))
+            data = utils.json_loads(job['response'])
+            for item in data.get('query', {}).get('pages', []):
+                if item.get('pageid') in pageids or len(pages) == count:
+                    continue
+                pageids.add(item.get('pageid'))
+                page = WPTools(item['title'], **kwargs)
+                page._set_random(item, job['url'], job['info'],
+                                 job['response'])
+                pages.append(page)
+
+        if count - len(pages) == need:
+            break
+
+    if show:
+        for page in pages:
+            page.show()
+
+    return pages
+
+
+def fetch_many(pages, actions=None, show=False, proxy=None, timeout=0,
+               maxhost=6, strict=False):
+    """
+    make requests for many pages at once, returns pages
+    - actions: <list> WPTools actions (default: query, parse, wikidata)
+    - maxhost: <int> maximum concurrent requests per host
+    - strict: <bool> raise the first LookupError instead
+
+    Requests run in rounds: each round sends every (page, action) that
+    is ready at once, then sets page data in (pages, actions) order.
+    Query actions for pages on the same wiki share one action=query
+    (fetch.QUERY_LIMIT titles or pageids at a time), and wikidata
+    actions share one wbgetentities (fetch.WIKIDATA_LIMIT ids or
+    titles). Wikidata waits for query on pages without a wikibase
+    (query finds it), and a wikidata lookup by title that misses is
+    retried once, by id or alone with a normalized title. Follow-up
+    claims go in later rounds, the distinct Q-ids of all pages (per
+    language) sharing wbgetentities requests. Images missing info (from
+    imageinfo in actions or as a follow-up) are resolved last, for all
+    pages at once (see _imageinfo_many). Pages that fail are marked
+    fatal and skipped thereafter.
+    """
+    if actions is None:
+        actions = ['query', 'parse', 'wikidata']
+
+    images = []
+    if 'imageinfo' in actions:
+        images = list(pages)
+
+    todo = [(page, action) for page in pages for action in actions
+            if action != 'imageinfo']
+
+    retried = []
+    while todo:
+        ready = [x for x in todo if x[0]._ready(x[1], proxy, timeout)
+                 and not _waits(x[0], x[1], todo)]
+
+        if not ready:
+            for page, action in todo:
+                error = "%s not ready for %s" % (page.title, action)
+                if strict:
+                    raise LookupError(error)
+                utils.stderr(error, page.silent)
+            break
+
+        todo = [x for x in todo if x not in ready]
+
+        handled, retry = _perform(ready, proxy, timeout, maxhost, strict,
+                                  retried)
+        retried.extend(retry)
+        todo.extend(retry)
+
+        for page, action in handled:
+            for pending in page._pending(action):
+                if pending == 'imageinfo':
+                    if page not in images:
+                        images.append(page)
+                elif (page, pending) not in todo:
+                    todo.append((page, pending))
+
+    _imageinfo_many(images, proxy, timeout, maxhost, strict)
+
+    if show:
+        for page in pages:
+            page.show()
+
+    return pages
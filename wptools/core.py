@@ -13,11 +13,14 @@ except ImportError:  # python3
     from urllib.parse import quote, urlparse
 
 import collections
+import functools
 import re
 
 import html2text
 
+from . import batch
 from . import fetch
+from . import store
 from . import utils
 
 
@@ -66,17 +69,67 @@ class WPTools(object):
                   'P1773': 'attribution',
                   'P1779': 'creator'}
 
+    # attribute: actions that can populate it, cheapest first
+    _FIELDS = {'claims': ['wikidata'],
+               'description': ['query', 'wikidata', 'rest'],
+               'exhtml': ['rest'],
+               'extext': ['query'],
+               'extract': ['query'],
+               'image': ['query', 'rest', 'wikidata', 'parse'],
+               'images': ['query', 'rest', 'wikidata', 'parse'],
+               'infobox': ['parse'],
+               'label': ['query', 'wikidata'],
+               'lead': ['rest'],
+               'links': ['parse'],
+               'modified': ['query', 'rest'],
+               'pageid': ['query', 'parse', 'rest'],
+               'parsetree': ['parse'],
+               'props': ['wikidata'],
+               'random': ['query'],
+               'title': ['query', 'parse', 'rest', 'wikidata'],
+               'url': ['query', 'rest'],
+               'url_raw': ['query', 'rest'],
+               'what': ['wikidata'],
+               'wikibase': ['query', 'parse', 'wikidata'],
+               'wikidata': ['wikidata'],
+               'wikidata_url': ['query', 'parse', 'wikidata'],
+               'wikitext': ['parse']}
+
+    # attribute: follow-up action it needs
+    _FOLLOWUPS = {'image': 'imageinfo',
+                  'images': 'imageinfo',
+                  'what': 'claims',
+                  'wikidata': 'claims'}
+
+    # attribute: action=parse prop that populates it
+    _PARSE_PROPS = {'image': 'parsetree',
+                    'images': 'parsetree',
+                    'infobox': 'parsetree',
+                    'links': 'iwlinks',
+                    'parsetree': 'parsetree',
+                    'wikibase': 'properties',
+                    'wikidata_url': 'properties',
+                    'wikitext': 'wikitext'}
+
+    # attributes still complete when parsing only section 0
+    _PARSE_LEAD = ['image', 'images', 'infobox', 'pageid', 'title',
+                   'wikibase', 'wikidata_url']
+
     _defer_imageinfo = False
+    _lazy_images = ()
+    _parse_fields = None
+    _parse_section = None
+    _planned = None
 
     actions = ['parse', 'query', 'wikidata', 'rest', 'claims', 'imageinfo']
     description = None
     exhtml = None
-    extext = None
+    extext = utils.LazyAttribute('extext')
     extract = None
     fatal = False
-    infobox = None
+    infobox = utils.LazyAttribute('infobox')
     label = None
-    lead = None
+    lead = utils.LazyAttribute('lead')
     links = None
     parsetree = None
     random = None
@@ -94,15 +147,22 @@ class WPTools(object):
                 self.title = args[0].replace(' ', '_')
 
         self.argprops = kwargs.get('props')
+        self.keep_raw = kwargs.get('keep_raw', True)
         self.lang = kwargs.get('lang') or 'en'
+        self.lazy = kwargs.get('lazy') or False
+        self.offline_images = kwargs.get('offline_images') or False
         self.pageid = kwargs.get('pageid')
         self.silent = kwargs.get('silent') or False
         self.skip = kwargs.get('skip') or ''
+        self.thumbs = kwargs.get('thumbs') or []
         self.variant = kwargs.get('variant')
         self.verbose = kwargs.get('verbose') or False
         self.wiki = kwargs.get('wiki')
         self.wikibase = kwargs.get('wikibase')
 
+        self._deferred = {}
+        self._labeled = set()
+
         self.cache = {}
         self.claims = {}
         self.images = []
@@ -118,10 +178,22 @@ class WPTools(object):
         if self.argprops:
             self.update_wikiprops(self.argprops)
 
+        if self.lazy:
+            return
+
         if not self.pageid and not self.title and not self.wikibase:
-            self.get_random()
-        else:
-            self.show()
+            self._set_random_title()
+
+        self.show()
+
+    def __getstate__(self):
+        """
+        returns state to pickle, computing deferred attributes first
+        (their functions are bound closures)
+        """
+        for attr in list(self._deferred):
+            getattr(self, attr)
+        return self.__dict__
 
     def __get_entity_prop(self, entity, prop):
         """
@@ -134,30 +206,64 @@ class WPTools(object):
             except AttributeError:
                 return ent.get('value')
 
-    def __get_image_files(self):
+    def __get_extext(self, extract):
         """
-        returns normalized list of image filenames
+        returns plain text (Markdown) from HTML extract
         """
+        extext = html2text.html2text(extract)
+        if extext:
+            return extext.strip()
+
+    def __get_image_files(self, images=None):
+        """
+        returns normalized list of image filenames (default: all)
+        """
+        if images is None:
+            images = self.images
         files = []
-        for item in [x['file'] for x in self.images if x.get('file')]:
-            fname = item.replace('_', ' ')
-            if (not fname.startswith('File')
-                    and not fname.startswith('Image')):
-                fname = 'File:' + fname
+        for item in [x['file'] for x in images if x.get('file')]:
+            fname = utils.file_title(item)
             if fname not in files:
                 files.append(fname)
         return files
 
+    def __get_infobox(self, ptree=None, wikitext=None):
+        """
+        returns infobox from parse tree (or wikitext), adding its images
+        """
+        if ptree:
+            infobox = utils.get_infobox(ptree)
+        else:
+            infobox = utils.get_wikitext_infobox(wikitext)
+
+        if infobox:
+            if infobox.get('image'):
+                self.images.append({'kind': 'parse-image',
+                                    'file': infobox['image']})
+            if infobox.get('Cover'):
+                self.images.append({'kind': 'parse-cover',
+                                    'file': infobox['Cover']})
+
+        return infobox
+
     def __get_lead(self, data):
         """
-        returns lead HTML with heading and image and refs removed
+        returns function that returns lead HTML with heading and image
+        and refs removed (snipping refs on call)
         """
-        lead = []
-        lead.append(self.__get_lead_image())
-        lead.append(self.__get_lead_heading())
-        lead.append(self.__get_lead_rest(data))
-        lead.append(self.__get_lead_metadata())
-        return "\n".join([x for x in lead if x])
+        image = self.__get_lead_image()
+        heading = self.__get_lead_heading()
+        html = self.__get_lead_rest(data)
+        metadata = self.__get_lead_metadata()
+
+        def _lead():
+            lead = [image, heading]
+            if html:
+                lead.append(self.__postprocess_lead(html))
+            lead.append(metadata)
+            return "\n".join([x for x in lead if x])
+
+        return _lead
 
     def __get_lead_heading(self):
         """
@@ -221,7 +327,7 @@ class WPTools(object):
             html = "\n".join(pars)
             self.exhtml = html
             self.cache['rest']['html'] = html
-            return self.__postprocess_lead(html)
+            return html
 
     def __postprocess_lead(self, html):
         """
@@ -238,10 +344,10 @@ class WPTools(object):
         """
         update images with get_imageinfo data
         """
+        title = utils.file_title(title)
         for i, image in enumerate(self.images):
             if image.get('file'):
-                fname = image.get('file').replace('_', ' ')
-                if fname.lower() in title.lower():
+                if utils.file_title(image['file']) == title:
                     if image.get('kind') != 'query-thumbnail':
                         self.images[i].update(info)
 
@@ -268,12 +374,20 @@ class WPTools(object):
                 attr = "%s_%s" % (attr, suffix)
                 setattr(self, attr, value)
 
+    def _defer(self, attr, func):
+        """
+        set attr to func() on first read (see utils.LazyAttribute)
+        """
+        self.__dict__.pop(attr, None)
+        self._deferred[attr] = func
+
     def _fetch(self, proxy, timeout):
         """
         returns wptools.fetch object for making HTTP requests
         """
         return fetch.WPToolsFetch(
             lang=self.lang,
+            page=self._page_key(),
             silent=self.silent,
             variant=self.variant,
             verbose=self.verbose,
@@ -287,13 +401,14 @@ class WPTools(object):
         """
         try:
             query = self.cache[action]['query'].replace('&format=json', '')
-            data = utils.json_loads(self.cache[action]['response'])
+            data = self._response_data(action)
 
             if action == 'parse' and not data.get('parse'):
                 raise LookupError
 
             if action == 'query':
-                if [x for x in data['query']['pages'] if x.get('missing')]:
+                pages = data['query']['pages']
+                if not pages or [x for x in pages if x.get('missing')]:
                     raise LookupError
 
             if action == 'wikidata' and '-1' in data.get('entities'):
@@ -304,11 +419,35 @@ class WPTools(object):
         except (LookupError, ValueError):
             raise LookupError(query)
 
+    def _get_lazy_imageinfo(self):
+        """
+        get_imageinfo() for offline images, on first read of a size
+        """
+        lazy = [x for x in self.images if getattr(x, 'resolve', None)]
+        for image in lazy:
+            image.resolve = None
+
+        self._lazy_images = lazy
+        try:
+            self.get_imageinfo(False)
+        finally:
+            self._lazy_images = ()
+
+    def _gather_images(self):
+        """
+        read deferred infobox, which adds its images (parse-image,
+        parse-cover)
+        """
+        if 'infobox' in self._deferred:
+            getattr(self, 'infobox')
+
     def _missing_imageinfo(self):
         """
-        returns images missing info
+        returns images missing info (gathering images first)
         """
-        return [x for x in self.images if not x.get('url')]
+        self._gather_images()
+        return [x for x in self.images if not x.get('url')
+                or [y for y in self._lazy_images if y is x]]
 
     def _marshal_claims(self, query_claims):
         """
@@ -324,11 +463,72 @@ class WPTools(object):
                 else:
                     self._update_wikidata(label, val)
 
-    def _query(self, action, _fetch):
+    def _imageinfo_files(self):
+        """
+        returns normalized filenames of images missing imageinfo
+        """
+        return self.__get_image_files(self._missing_imageinfo())
+
+    def _merge_responses(self, responses):
+        """
+        returns chunked responses as one (decoded) response,
+        wbgetentities (claims) entities or action=query (imageinfo) pages
+        """
+        entities = {}
+        pages = []
+        for response in responses:
+            try:
+                data = utils.json_loads(response)
+            except (TypeError, ValueError):
+                continue
+            entities.update(data.get('entities') or {})
+            pages.extend(data.get('query', {}).get('pages') or [])
+        if pages:
+            return {'query': {'pages': pages}}
+        return {'entities': entities}
+
+    def _queries(self, action, proxy, timeout):
+        """
+        returns list of (WPToolsFetch, query) needed for action,
+        more than one if claims exceed fetch.WIKIDATA_LIMIT ids or
+        imageinfo files exceed fetch.IMAGEINFO_LIMIT
+        """
+        if action == 'claims':
+            ids = [x for x in self.claims if x not in self._labeled]
+            requests = []
+            for i in range(0, len(ids), fetch.WIKIDATA_LIMIT):
+                _fetch = self._fetch(proxy, timeout)
+                chunk = ids[i:i + fetch.WIKIDATA_LIMIT]
+                requests.append((_fetch, self._query(action, _fetch, chunk)))
+            return requests
+
+        if action == 'imageinfo':
+            files = self._imageinfo_files()
+            requests = []
+            for i in range(0, len(files), fetch.IMAGEINFO_LIMIT):
+                _fetch = self._fetch(proxy, timeout)
+                chunk = files[i:i + fetch.IMAGEINFO_LIMIT]
+                requests.append((_fetch, self._query(action, _fetch, chunk)))
+            return requests
+
+        _fetch = self._fetch(proxy, timeout)
+        return [(_fetch, self._query(action, _fetch))]
+
+    def _query(self, action, _fetch, ids=None):
         """
         returns WPToolsFetch query based on action
+        - ids: <list> claims Q-ids (default: all without label)
+          or imageinfo files (default: all missing imageinfo)
         """
-        if action == 'query' or action == 'parse':
+        if action == 'parse':
+            props = self._parse_props()
+            if self.pageid:
+                return _fetch.query(action, self.pageid, pageid=True,
+                                    props=props, section=self._parse_section)
+            return _fetch.query(action, self.title, props=props,
+                                section=self._parse_section)
+
+        elif action == 'query':
             if self.pageid:
                 return _fetch.query(action, self.pageid, pageid=True)
             return _fetch.query(action, self.title)
@@ -350,72 +550,209 @@ class WPTools(object):
             return _fetch.query('/page/mobile-text/', title)
 
         elif action == 'claims':
-            thing = {'id': "|".join(self.claims.keys()), 'props': 'labels'}
+            if ids is None:
+                ids = [x for x in self.claims if x not in self._labeled]
+            thing = {'id': "|".join(ids), 'props': 'labels'}
             return _fetch.query('claims', thing)
 
         elif action == 'imageinfo':
-            files = self.__get_image_files()
+            files = ids
+            if files is None:
+                files = self._imageinfo_files()
             try:
                 files = [quote(x) for x in files]
             except KeyError:
                 files = [quote(x.encode('utf-8')) for x in files]
             return _fetch.query('imageinfo', '|'.join(files))
 
-    def _request(self, action, show, proxy, timeout):
+    def _page_key(self):
         """
-        make HTTP request and cache response
+        returns key of this page's entries in store.RESPONSES
         """
-        if action in self.cache:
-            if action != 'imageinfo':
-                utils.stderr("%s results in cache" % action)
-                return
+        return "%s|%s" % (self.wiki or self.lang,
+                          self.title or self.pageid or self.wikibase)
 
-        if action in self.skip:
-            utils.stderr("skipping %s" % action)
-            return
+    def _parse_covers(self):
+        """
+        returns True if cached parse has the props and section that
+        parse would request now
+        """
+        cached = self.cache['parse']
+        if not isinstance(cached, dict):
+            return True
+        section = cached.get('section')
+        if section is not None and section != self._parse_section:
+            return False
+        have = cached.get('props') or fetch.WPToolsFetch.PARSE_PROPS
+        need = self._parse_props() or fetch.WPToolsFetch.PARSE_PROPS
+        return set(need.split('|')) <= set(have.split('|'))
 
-        _fetch = self._fetch(proxy, timeout)
-        query = self._query(action, _fetch)
+    def _parse_props(self):
+        """
+        returns action=parse props for _parse_fields (None: all)
+        """
+        if self._parse_fields:
+            return "|".join(sorted(set(
+                [self._PARSE_PROPS[x] for x in self._parse_fields
+                 if x in self._PARSE_PROPS]))) or 'properties'
 
-        req = {}
-        req['query'] = query
-        req['response'] = _fetch.curl(query)
-        req['info'] = _fetch.info
+    def _pending(self, action):
+        """
+        returns follow-up actions needed after action (imageinfo too
+        while infobox images are not gathered yet)
+        """
+        pending = []
+        if action == 'wikidata' and self.claims:
+            pending.append('claims')
+        if action in ['parse', 'query', 'rest', 'wikidata']:
+            images = 'infobox' in self._deferred or self._missing_imageinfo()
+            if images and not self._defer_imageinfo:
+                pending.append('imageinfo')
+        if self._planned is not None:
+            return [x for x in pending if x in self._planned]
+        return pending
 
-        self.cache[action] = req
+    def _plan(self, fields):
+        """
+        returns (actions, follow-ups) that cheaply populate fields
+        """
+        for field in fields:
+            if field not in self._FIELDS:
+                raise ValueError("unknown field: %s" % field)
+
+        actions = []
+        if self.wikibase and not self.title and not self.pageid:
+            actions.append('wikidata')  # for title
+            order = ['wikidata', 'query', 'parse', 'rest']
+        else:
+            order = ['query', 'parse', 'wikidata', 'rest']
+
+        for field in sorted(fields, key=lambda x: len(self._FIELDS[x])):
+            if not [x for x in self._FIELDS[field] if x in actions]:
+                actions.append(self._FIELDS[field][0])
+
+        if self.pageid and not self.title and not self.wikibase:
+            if [x for x in actions if x in ['rest', 'wikidata']]:
+                actions.append('query')  # for title
+
+        actions = [x for x in order if x in actions]
+        followups = set([self._FOLLOWUPS[x] for x in fields
+                         if x in self._FOLLOWUPS])
+
+        return actions, followups
+
+    def _ready(self, action, proxy=None, timeout=0):
+        """
+        returns True if we have what action needs to make a request
+        (a lazy page without title, pageid or wikibase gets a random
+        title first)
+        """
+        if self._untitled():
+            self._set_random_title(0, proxy, timeout)
 
         if action == 'claims':
-            self._set_claims_data()
-        elif action == 'imageinfo':
-            self._set_imageinfo_data()
-        elif action == 'parse':
-            self._set_parse_data()
-        elif action == 'query':
-            self._set_query_data()
-        elif action == 'rest':
-            self._set_rest_data()
-        elif action == 'wikidata':
-            self._set_wikidata()
-            if self.claims:
-                self.get_claims(show=False)
+            return bool(self.claims)
+        if action == 'imageinfo':
+            self._gather_images()
+            return bool(self.images)
+        if action == 'parse' or action == 'query':
+            return bool(self.title or self.pageid)
+        if action == 'rest':
+            return bool(self.title)
+        if action == 'wikidata':
+            return bool(self.wikibase or (self.lang and self.title))
+        return False
 
-        if action in ['parse', 'query', 'rest', 'wikidata']:
-            if self._missing_imageinfo() and not self._defer_imageinfo:
-                self.get_imageinfo(show=False)
+    def _request(self, action, show, proxy, timeout):
+        """
+        make HTTP request and cache response
+        """
+        if self._skip(action):
+            return
+
+        requests = self._queries(action, proxy, timeout)
+        data = None
+        if len(requests) == 1:
+            _fetch, query = requests[0]
+            response = _fetch.curl(query)
+            info = _fetch.info
+        else:
+            multi = fetch.WPToolsMulti()
+            for _fetch, query in requests:
+                multi.add(_fetch, query)
+            jobs = multi.perform()
+            for job in jobs:
+                if job['error']:
+                    raise job['error']
+            query = jobs[0]['url']
+            info = jobs[0]['info']
+            response = None
+            data = self._merge_responses([x['response'] for x in jobs])
+
+        self._set_response(action, query, response, info, data)
+
+        for pending in self._pending(action):
+            if pending == 'imageinfo' and not self._missing_imageinfo():
+                continue
+            getattr(self, 'get_' + pending)(False, proxy, timeout)
 
         if show:
             self.show()
 
+    def _resolve_claims(self):
+        """
+        set claim labels found in store.LABELS, returns Q-ids missing
+        """
+        lang = self.variant or self.lang
+        missing = []
+        for qid in self.claims:
+            if qid in self._labeled:
+                continue
+            label = store.LABELS.get("%s|%s" % (qid, lang))
+            if label is None:
+                missing.append(qid)
+            else:
+                self._set_claim_label(qid, label)
+
+        self.what = self.wikidata.get('instance')
+        return missing
+
+    def _resolve_images(self):
+        """
+        set image info found in store.IMAGES, returns files missing
+        """
+        site = self.wiki or self.lang
+        missing = []
+        for fname in self._imageinfo_files():
+            info = store.IMAGES.get("%s|%s" % (site, fname))
+            if info is None:
+                info = store.IMAGES.get(fname)
+            if info is None:
+                missing.append(fname)
+            else:
+                self.__update_imageinfo(fname, info)
+        return missing
+
+    def _set_claim_label(self, qid, label):
+        """
+        set Wikidata from claim label (once per Q-id)
+        """
+        if qid not in self._labeled:
+            self._labeled.add(qid)
+            self._update_wikidata(self.claims[qid], label)
+
     def _set_claims_data(self):
         """
         set property claim labels from get_claims()
         """
         data = self._load_response('claims')
         entities = data.get('entities')
+        lang = self.variant or self.lang
         for item in entities:
-            attr = self.claims[item]
             value = self.__get_entity_prop(entities[item], 'labels')
-            self._update_wikidata(attr, value)
+            if value is not None:
+                store.LABELS.set("%s|%s" % (item, lang), value)
+            self._set_claim_label(item, value)
 
         self.what = self.wikidata.get('instance')
 
@@ -429,9 +766,33 @@ class WPTools(object):
             title = page.get('title')
             if page.get('imageinfo'):
                 for info in page['imageinfo']:
+                    info = dict(info)  # keep response data as sent
                     info.update({'file': title})
                     self.__update_imageinfo(title, info)
 
+                key = title
+                if page.get('imagerepository') == 'local':
+                    key = "%s|%s" % (self.wiki or self.lang, title)
+                store.IMAGES.set(key, dict(info))
+
+    def _set_offline_images(self):
+        """
+        set image URLs (url, descriptionurl, thumbs) computed from file
+        names, leaving size, width, height and timestamp to be fetched
+        on first read (assumes Commons files)
+        """
+        for i, image in enumerate(self.images):
+            if image.get('url') or not image.get('file'):
+                continue
+            image = utils.LazyImage(image, self._get_lazy_imageinfo)
+            image['file'] = utils.file_title(image['file'])
+            image['url'] = utils.media_url(image['file'])
+            image['descriptionurl'] = utils.description_url(image['file'])
+            if self.thumbs:
+                image['thumbs'] = dict((x, utils.thumb_url(image['url'], x))
+                                       for x in self.thumbs)
+            self.images[i] = image
+
     def _set_parse_data(self):
         """
         set attributes derived from MediaWiki (action=parse)
@@ -439,24 +800,32 @@ class WPTools(object):
         pdata = self._load_response('parse')['parse']
 
         self.pageid = pdata.get('pageid')
-        self.parsetree = pdata.get('parsetree')
-        self.wikibase = pdata.get('properties').get('wikibase_item')
-        self.wikitext = pdata.get('wikitext')
 
-        self.infobox = utils.get_infobox(self.parsetree)
-        self.links = utils.get_links(pdata.get('iwlinks'))
-        self.wikidata_url = utils.wikidata_url(self.wikibase)
+        infobox = None
+        if pdata.get('parsetree'):
+            self.parsetree = pdata['parsetree']
+            infobox = functools.partial(self.__get_infobox,
+                                        ptree=self.parsetree)
+
+        if pdata.get('properties'):
+            self.wikibase = pdata['properties'].get('wikibase_item')
+            self.wikidata_url = utils.wikidata_url(self.wikibase)
+
+        if pdata.get('wikitext'):
+            self.wikitext = pdata['wikitext']
+            if not pdata.get('parsetree'):
+                infobox = functools.partial(self.__get_infobox,
+                                            wikitext=self.wikitext)
+
+        if pdata.get('iwlinks') is not None:
+            self.links = utils.get_links(pdata['iwlinks'])
 
         if pdata.get('title'):
             self.title = pdata['title'].replace(' ', '_')
 
-        if self.infobox:
-            if self.infobox.get('image'):
-                self.images.append({'kind': 'parse-image',
-                                    'file': self.infobox['image']})
-            if self.infobox.get('Cover'):
-                self.images.append({'kind': 'parse-cover',
-                                    'file': self.infobox['Cover']})
+        # infobox (and its images) on first read, or _gather_images()
+        if infobox:
+            self._defer('infobox', infobox)
 
     def _set_query_data(self):
         """
@@ -467,14 +836,13 @@ class WPTools(object):
 
         self.modified['page'] = page.get('touched')
         self.pageid = page.get('pageid')
-        self.random = data['query']['random'][0]["title"]
+        if data['query'].get('random'):
+            self.random = data['query']['random'][0]["title"]
         self.title = page.get('title').replace(' ', '_')
 
         if page.get('extract'):
             self.extract = page['extract']
-            extext = html2text.html2text(self.extract)
-            if extext:
-                self.extext = extext.strip()
+            self._defer('extext', lambda: self.__get_extext(page['extract']))
 
         if page.get('fullurl'):
             self.url = page['fullurl']
@@ -533,7 +901,7 @@ class WPTools(object):
             self.title = title.replace(' ', '_')
 
         if data.get('sections'):
-            self.lead = self.__get_lead(data)
+            self._defer('lead', self.__get_lead(data))
 
         if data.get('thumb'):
             rthumb = {'kind': 'rest-thumb'}
@@ -544,6 +912,101 @@ class WPTools(object):
         self.url = "%s://%s/wiki/%s" % (url.scheme, url.netloc, self.title)
         self.url_raw = self.url + '?action=raw'
 
+    def _random_query(self, namespace=0, proxy=None, timeout=0):
+        """
+        returns (fetch, query) for fetch.RANDOM_LIMIT random titles
+        """
+        _fetch = self._fetch(proxy, timeout)
+        query = _fetch.query('random_titles', fetch.RANDOM_LIMIT,
+                             namespace=namespace)
+        return _fetch, query
+
+    def _random_titles(self, query, response):
+        """
+        returns random (pageid, title) from list=random response
+        """
+        try:
+            data = utils.json_loads(response)
+            return [(x['id'], x['title']) for x in data['query']['random']]
+        except (KeyError, ValueError):
+            raise LookupError(query.replace('&format=json', ''))
+
+    def _set_random_title(self, namespace=0, proxy=None, timeout=0):
+        """
+        set pageid and title from store.RANDOM pool (no request if any
+        left in pool)
+        """
+        def refill():
+            _fetch, query = self._random_query(namespace, proxy, timeout)
+            return self._random_titles(query, _fetch.curl(query))
+
+        key = (self.lang, self.wiki, namespace)
+        item = store.RANDOM.get(key, refill)
+        if item is None:
+            raise LookupError("no random pages in %s" % str(key))
+
+        self.pageid, title = item
+        self.title = title.replace(' ', '_')
+
+    def _set_random(self, item, query, info, response=None):
+        """
+        set title and get_query() data from generator=random page item
+        (of raw response)
+        """
+        self.pageid = item.get('pageid')
+        self.title = item['title'].replace(' ', '_')
+        self._set_response('query', query, response, info,
+                           {'query': {'pages': [item]}})
+
+    def _response_data(self, action):
+        """
+        returns decoded response for action, decoding the raw response
+        only once (then dropping it unless keep_raw)
+        """
+        req = self.cache[action]
+        if req.get('data') is None:
+            req['data'] = utils.json_loads(req['response'])
+            if not self.keep_raw:
+                req['response'] = None
+        return req['data']
+
+    def _set_response(self, action, query, response, info, data=None):
+        """
+        cache response (raw and/or already decoded data) and set
+        attributes derived from it
+        """
+        key = self._page_key()
+
+        req = {}
+        req['query'] = query
+        req['response'] = None if data and not self.keep_raw else response
+        req['info'] = info
+        req['data'] = data
+        if action == 'parse':
+            req['props'] = self._parse_props()
+            req['section'] = self._parse_section
+
+        self.cache[action] = req
+
+        if action == 'claims':
+            self._set_claims_data()
+        elif action == 'imageinfo':
+            self._set_imageinfo_data()
+        elif action == 'parse':
+            self._set_parse_data()
+        elif action == 'query':
+            self._set_query_data()
+        elif action == 'rest':
+            self._set_rest_data()
+        elif action == 'wikidata':
+            self._set_wikidata()
+
+        if self.offline_images:
+            self._set_offline_images()
+
+        if store.RESPONSES is not None and action in ['query', 'rest']:
+            store.RESPONSES.invalidate(key, self.modified.get('page'))
+
     def _set_wikidata(self):
         """
         set attributes derived from Wikidata (action=wbentities)
@@ -569,6 +1032,35 @@ class WPTools(object):
             for image in images:
                 self.images.append({'kind': 'wikidata-image', 'file': image})
 
+    def _skip(self, action):
+        """
+        returns True if action is cached or skipped, or needs no request
+        """
+        if action in self.cache and action != 'imageinfo':
+            if action != 'parse' or self._parse_covers():
+                utils.stderr("%s results in cache" % action)
+                return True
+
+        if action in self.skip:
+            utils.stderr("skipping %s" % action)
+            return True
+
+        if action == 'claims' and not self._resolve_claims():
+            utils.stderr("claims labels in store", self.silent)
+            return True
+
+        if action == 'imageinfo' and not self._resolve_images():
+            utils.stderr("imageinfo in store", self.silent)
+            return True
+
+        return False
+
+    def _untitled(self):
+        """
+        returns True if lazy page still needs a random title
+        """
+        return self.lazy and not (self.title or self.pageid or self.wikibase)
+
     def _update_wikidata(self, label, value):
         """
         add or update Wikidata
@@ -616,26 +1108,80 @@ class WPTools(object):
 
         return dict(props)
 
-    def get(self, show=True, proxy=None, timeout=0):
+    def aget(self, show=True, proxy=None, timeout=0):
+        """
+        awaitable get() on the asyncio event loop (python 3.5+)
+        """
+        from . import aio
+        return aio.get(self, show, proxy, timeout)
+
+    def aget_claims(self, show=True, proxy=None, timeout=0):
+        """
+        awaitable get_claims()
+        """
+        from . import aio
+        return aio.request(self, 'claims', show, proxy, timeout)
+
+    def aget_imageinfo(self, show=True, proxy=None, timeout=0):
+        """
+        awaitable get_imageinfo()
+        """
+        from . import aio
+        return aio.request(self, 'imageinfo', show, proxy, timeout)
+
+    def aget_parse(self, show=True, proxy=None, timeout=0):
+        """
+        awaitable get_parse()
+        """
+        from . import aio
+        return aio.request(self, 'parse', show, proxy, timeout)
+
+    def aget_query(self, show=True, proxy=None, timeout=0):
+        """
+        awaitable get_query()
         """
-        make requests needed to populate most the things.
-        some sequence of:
+        from . import aio
+        return aio.request(self, 'query', show, proxy, timeout)
+
+    def aget_rest(self, show=True, proxy=None, timeout=0):
+        """
+        awaitable get_rest()
+        """
+        from . import aio
+        return aio.request(self, 'rest', show, proxy, timeout)
+
+    def aget_wikidata(self, show=True, proxy=None, timeout=0):
+        """
+        awaitable get_wikidata()
+        """
+        from . import aio
+        return aio.request(self, 'wikidata', show, proxy, timeout)
+
+    def get(self, show=True, proxy=None, timeout=0, fields=None):
+        """
+        make requests needed to populate most the things:
         - get_query()
         - get_parse()
         - get_wikidata()
+        or only those needed for fields, e.g. fields=['infobox', 'image']
+
+        Requests that are ready run at the same time (e.g. query and
+        parse given a title, then wikidata by the wikibase query finds;
+        query and parse once wikidata finds the title given a wikibase),
+        then claims. Responses are applied
+        in the order above either way. Finally, one get_imageinfo() for
+        all images still missing info.
         """
+        if fields:
+            return self.get_fields(fields, show, proxy, timeout)
+
         if self.wikibase and not self.title:
-            self._defer_imageinfo = True
-            self.get_wikidata(False, proxy, timeout)
-            self.get_query(False, proxy, timeout)
-            self._defer_imageinfo = False
-            self.get_parse(show, proxy, timeout)
+            actions = ['wikidata', 'query', 'parse', 'imageinfo']
         else:
-            self._defer_imageinfo = True
-            self.get_query(False, proxy, timeout)
-            self.get_parse(False, proxy, timeout)
-            self._defer_imageinfo = False
-            self.get_wikidata(show, proxy, timeout)
+            actions = ['query', 'parse', 'wikidata', 'imageinfo']
+
+        batch.fetch_many([self], actions, show, proxy, timeout, strict=True)
+
         return self
 
     def get_claims(self, show=True, proxy=None, timeout=0):
@@ -643,32 +1189,64 @@ class WPTools(object):
         Wikidata:API (action=wbgetentities) for labels of claims
         - e.g. {'Q298': 'country'} resolves to {'country': 'Chile'}
         - use get_wikidata() to populate claims
+        - only requests labels missing from wptools.store.LABELS
         """
-        if not self.claims:
+        if not self._ready('claims', proxy, timeout):
             raise LookupError("get_claims needs claims")
 
         self._request('claims', show, proxy, timeout)
 
         return self
 
+    def get_fields(self, fields, show=True, proxy=None, timeout=0):
+        """
+        make only the requests needed to populate fields (attributes)
+        - e.g. ['description'] needs only get_query()
+        - claims and imageinfo follow only for fields that need them
+          (what, wikidata; image, images)
+        """
+        actions, followups = self._plan(fields)
+        if 'imageinfo' in followups:
+            actions.append('imageinfo')
+
+        self._parse_fields = [x for x in fields if x in self._PARSE_PROPS]
+        if not [x for x in fields if 'parse' in self._FIELDS[x]
+                and x not in self._PARSE_LEAD]:
+            self._parse_section = 0
+        self._planned = followups
+        try:
+            batch.fetch_many([self], actions, False, proxy, timeout,
+                             strict=True)
+        finally:
+            self._parse_fields = None
+            self._parse_section = None
+            self._planned = None
+
+        if show:
+            self.show()
+
+        return self
+
     def get_imageinfo(self, show=True, proxy=None, timeout=0):
         """
         MediaWiki request for API:Imageinfo
         - images: <dict> updates image URLs, sizes, etc.
+        - only requests files missing from wptools.store.IMAGES
         https://www.mediawiki.org/wiki/API:Imageinfo
         """
-        if not self.images:
+        if not self._ready('imageinfo', proxy, timeout):
             raise LookupError("get_images needs images")
 
-        if not self._missing_imageinfo() and 'imageinfo' in self.cache:
-            utils.stderr("complete imageinfo in cache")
-            return
+        if not self._missing_imageinfo():
+            utils.stderr("imageinfo complete", self.silent)
+            return self
 
         self._request('imageinfo', show, proxy, timeout)
 
         return self
 
-    def get_parse(self, show=True, proxy=None, timeout=0):
+    def get_parse(self, show=True, proxy=None, timeout=0, fields=None,
+                  section=None):
         """
         MediaWiki:API action=parse request for:
         - images: <dict> {parse-image, parse-cover}
@@ -679,11 +1257,19 @@ class WPTools(object):
         - wikibase: <str> Wikidata entity ID or wikidata URL
         - wikitext: <str> raw wikitext URL
         https://en.wikipedia.org/w/api.php?action=help&modules=parse
+        fields: <list> only request props for these attributes
+        section: <int> only parse this section (e.g. 0 for infobox)
         """
-        if not self.title and not self.pageid:
+        if not self._ready('parse', proxy, timeout):
             raise LookupError("get_parse needs title or pageid")
 
-        self._request('parse', show, proxy, timeout)
+        self._parse_fields = fields
+        self._parse_section = section
+        try:
+            self._request('parse', show, proxy, timeout)
+        finally:
+            self._parse_fields = None
+            self._parse_section = None
 
         return self
 
@@ -702,7 +1288,7 @@ class WPTools(object):
         - url_raw: <str> ostensible raw wikitext URL
         https://en.wikipedia.org/w/api.php?action=help&modules=query
         """
-        if not self.title and not self.pageid:
+        if not self._ready('query', proxy, timeout):
             raise LookupError("get_query needs title or pageid")
 
         self._request('query', show, proxy, timeout)
@@ -711,25 +1297,24 @@ class WPTools(object):
 
     def get_random(self, show=True, proxy=None, timeout=0):
         """
-        MediaWiki:API (action=query) request for:
+        MediaWiki:API (action=query&generator=random) request for a
+        random article and its get_query() data in one go:
         - pageid: <int> Wikipedia database ID
         - title: <str> article title
+        - see get_query()
         https://www.mediawiki.org/wiki/API:Random
         """
         _fetch = self._fetch(proxy, timeout)
-        query = _fetch.query('random', None)
+        query = _fetch.query('random', 1)
         response = _fetch.curl(query)
 
         try:
             data = utils.json_loads(response)
-        except ValueError:
+            item = data['query']['pages'][0]
+        except (KeyError, IndexError, ValueError):
             raise LookupError(query.replace('&format=json', ''))
 
-        rand = data['query']['random'][0]
-        self.pageid = rand.get('id')
-
-        if rand.get('title'):
-            self.title = rand['title'].replace(' ', '_')
+        self._set_random(item, query, _fetch.info, response)
 
         if show:
             self.show()
@@ -748,7 +1333,7 @@ class WPTools(object):
         - url_raw: <str> ostensible raw wikitext URL
         https://en.wikipedia.org/api/rest_v1/
         """
-        if not self.title:
+        if not self._ready('rest', proxy, timeout):
             raise LookupError("get_rest needs a title")
 
         self._request('rest', show, proxy, timeout)
@@ -770,7 +1355,7 @@ class WPTools(object):
         - wikidata_url: <str> Wikidata URL
         https://www.wikidata.org/w/api.php?action=help&modules=wbgetentities
         """
-        if not self.wikibase and (not self.lang and not self.title):
+        if not self._ready('wikidata', proxy, timeout):
             raise LookupError("get_wikidata needs wikibase or lang and title")
 
         self._request('wikidata', show, proxy, timeout)
@@ -809,13 +1394,16 @@ class WPTools(object):
         or list of cached actions
         '''
         if action in self.actions and action in self.cache:
-            return utils.json_loads(self.cache[action]['response'])
+            return self._response_data(action)
         return self.cache.keys() or None
 
     def show(self):
         """
-        pretty-print instance attributes
+        pretty-print instance attributes (to stderr, unless silent)
         """
+        if self.silent:
+            return
+
         maxlen = 72
 
         def ptrunc(prefix, tail):
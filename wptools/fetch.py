@@ -7,19 +7,318 @@ WPTools Fetch module.
 from __future__ import print_function
 try:  # python2
     from urllib import unquote
+    from urlparse import urlparse
 except ImportError:  # python3
-    from urllib.parse import unquote
+    from urllib.parse import unquote, urlparse
 
+from collections import defaultdict
 from io import BytesIO
 from string import Template
 
 import random
 import sys
+import threading
+import time
 
 import certifi
 import pycurl
 
 from . import __title__, __contact__, __version__
+from . import store
+
+# action=query takes 50 titles, but TextExtracts only returns 20 intro
+# extracts per request (exlimit), so larger batches would need continues
+QUERY_LIMIT = 20
+
+# action=wbgetentities takes at most 50 ids or titles
+WIKIDATA_LIMIT = 50
+
+# API:Imageinfo titles per request
+IMAGEINFO_LIMIT = 50
+
+# list=random titles per request (rnlimit maximum, 5000 for bots)
+RANDOM_LIMIT = 500
+
+
+class CurlPool(object):
+    """
+    Process-wide pool of idle pycurl handles keyed by (wiki, proxy, timeout)
+
+    Handles keep their connections alive between requests, so borrowing
+    one for the same wiki skips DNS, TCP connect and TLS handshake.
+    (Transfers run by WPToolsMulti use the connections of the thread's
+    curl_multi() instead.) Borrowed handles belong to one thread until
+    they are released.
+
+    stats: handles borrowed, created (borrowed - created were idle) and
+    closed; HTTP transfers that made new connections (connects) and
+    that reused a connection (reused)
+    """
+
+    def __init__(self, maxidle=8):
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+        self.maxidle = maxidle
+        self.stats = {'borrowed': 0,
+                      'closed': 0,
+                      'connects': 0,
+                      'created': 0,
+                      'reused': 0}
+
+    def acquire(self, key, setup):
+        """
+        returns idle handle for key, or new handle from setup()
+        """
+        with self.lock:
+            self.stats['borrowed'] += 1
+            if self.idle[key]:
+                return self.idle[key].pop()
+            self.stats['created'] += 1
+        return setup()
+
+    def clear(self):
+        """
+        close all idle handles
+        """
+        with self.lock:
+            for key in self.idle:
+                for crl in self.idle[key]:
+                    crl.close()
+                    self.stats['closed'] += 1
+            self.idle.clear()
+
+    def count(self, info):
+        """
+        count connections made (or reused) by HTTP transfer info
+        """
+        if not info.get('url', '').startswith('http'):
+            return
+        with self.lock:
+            self.stats['connects'] += info['connects']
+            if not info['connects']:
+                self.stats['reused'] += 1
+
+    def release(self, key, crl, discard=False):
+        """
+        return handle to the pool, closing it if discard or pool is full
+        """
+        with self.lock:
+            if not discard and len(self.idle[key]) < self.maxidle:
+                self.idle[key].append(crl)
+                return
+            self.stats['closed'] += 1
+        crl.close()
+
+
+POOL = CurlPool()
+
+# per-thread pycurl.CurlMulti (see curl_multi)
+MULTI = threading.local()
+
+
+class Throttle(object):
+    """
+    Process-wide request policy:
+
+    - rate: <float> requests per second per host (None = unlimited),
+      a token bucket that allows bursts of up to burst requests
+    - maxlag: <int> MediaWiki API maxlag parameter (None = not sent)
+    - retries: <int> retries of 429, 5xx and maxlag responses, after
+      Retry-After seconds or exponential backoff (with jitter) from
+      backoff seconds, at most maxwait seconds
+
+    While a retry waits, no other request goes to the same host.
+    """
+
+    RETRY_STATUS = [429, 502, 503, 504]
+
+    def __init__(self, rate=None, burst=1, maxlag=None, retries=3,
+                 backoff=1.0, maxwait=60, clock=time.time):
+        self.backoff = backoff
+        self.buckets = {}
+        self.burst = burst
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.maxlag = maxlag
+        self.maxwait = maxwait
+        self.paused = {}
+        self.rate = rate
+        self.retries = retries
+        self.stats = {'retries': 0, 'throttled': 0}
+
+    def acquire(self, host):
+        """
+        reserve next request slot for host, returns seconds to wait
+        """
+        now = self.clock()
+        with self.lock:
+            start = max(now, self.paused.get(host, 0))
+            if self.rate:
+                tokens, stamp = self.buckets.get(host, (self.burst, start))
+                tokens = min(self.burst, tokens + (start - stamp) * self.rate)
+                if tokens < 1:
+                    start += (1 - tokens) / self.rate
+                    tokens = 1
+                self.buckets[host] = (tokens - 1, start)
+            if start > now:
+                self.stats['throttled'] += 1
+        return start - now
+
+    def delay(self, attempt, headers):
+        """
+        returns seconds to wait before retry attempt (from 0)
+        """
+        try:
+            return min(self.maxwait, max(0, int(headers['retry-after'])))
+        except (KeyError, TypeError, ValueError):
+            base = min(self.maxwait, self.backoff * 2 ** attempt)
+            return base / 2 + random.uniform(0, base / 2)
+
+    def retry(self, host, attempt, info, headers):
+        """
+        returns True if response (info, headers) should be retried,
+        pausing host until then
+        """
+        if attempt >= self.retries or not self.retryable(info, headers):
+            return False
+
+        delay = self.delay(attempt, headers or {})
+        with self.lock:
+            self.paused[host] = max(self.paused.get(host, 0),
+                                    self.clock() + delay)
+            self.stats['retries'] += 1
+        return True
+
+    def retryable(self, info, headers):
+        """
+        returns True if response (info, headers) is worth retrying:
+        429, 5xx (RETRY_STATUS) or maxlag error
+        """
+        if not info:
+            return False
+        maxlag = (headers or {}).get('mediawiki-api-error') == 'maxlag'
+        return info.get('status') in self.RETRY_STATUS or maxlag
+
+
+THROTTLE = Throttle()
+
+
+class WPToolsMulti(object):
+    """
+    Performs many HTTP GETs at once with pycurl.CurlMulti
+    """
+
+    def __init__(self, maxhost=6):
+        self.jobs = []
+        self.maxhost = maxhost
+        self.queue = defaultdict(list)
+
+    def add(self, _fetch, url):
+        """
+        queue GET of url with WPToolsFetch settings, returns job dict
+        """
+        job = {'error': None,
+               'fetch': _fetch,
+               'info': None,
+               'key': _fetch.pool_key(url),
+               'response': None,
+               'retries': 0,
+               'url': url,
+               'waited': 0}
+        self.jobs.append(job)
+
+        body = _fetch.cached(url)
+        if body is not None:
+            job['response'] = body
+            job['info'] = _fetch.info
+            return job
+
+        self.queue[job['key'][0]].append(job)
+        return job
+
+    def perform(self):
+        """
+        performs queued jobs, at most maxhost at once per host
+        """
+        multi = curl_multi()
+        active = {}
+        running = defaultdict(int)
+
+        def _next():
+            """seconds until next queued job may start, or None"""
+            starts = [self.queue[x][0].get('start', 0) for x in self.queue
+                      if self.queue[x] and running[x] < self.maxhost]
+            if starts:
+                return max(0, min(starts) - time.time())
+
+        def _start():
+            now = time.time()
+            for host in self.queue:
+                while self.queue[host] and running[host] < self.maxhost:
+                    job = self.queue[host][0]
+                    if 'start' not in job:
+                        wait = THROTTLE.acquire(host)
+                        job['start'] = now + wait
+                        job['waited'] += wait
+                    if job['start'] > now:
+                        break
+                    self.queue[host].pop(0)
+                    crl = POOL.acquire(job['key'], job['fetch'].curl_setup)
+                    job['buffer'] = job['fetch'].curl_prepare(crl, job['url'])
+                    running[host] += 1
+                    active[crl] = job
+                    multi.add_handle(crl)
+
+        def _finish(crl, error=None):
+            multi.remove_handle(crl)
+            job = active.pop(crl)
+            host = job['key'][0]
+            running[host] -= 1
+            if error:
+                job['error'] = error
+                job['buffer'].close()
+                POOL.release(job['key'], crl, discard=True)
+            else:
+                _fetch = job['fetch']
+                job['response'] = _fetch.curl_finish(crl, job['buffer'])
+                POOL.release(job['key'], crl)
+                if _fetch.retry(job['url'], job['retries']):
+                    job['retries'] += 1
+                    del job['start']
+                    self.queue[host].insert(0, job)
+                else:
+                    job['info'] = _fetch.throttle_info(job['retries'],
+                                                       job['waited'])
+                    _fetch.cache_response(job['url'], job['response'])
+            del job['buffer']
+
+        try:
+            _start()
+            while active or _next() is not None:
+                while active:
+                    ret, _ = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while active:
+                    queued, done, failed = multi.info_read()
+                    for crl in done:
+                        _finish(crl)
+                    for crl, errno, errmsg in failed:
+                        _finish(crl, pycurl.error(errno, errmsg))
+                    if not queued:
+                        break
+                _start()
+                wait = _next()
+                if active:
+                    multi.select(1.0 if wait is None else min(1.0, wait))
+                elif wait:
+                    time.sleep(wait)
+        finally:
+            for crl in active:  # interrupted
+                multi.remove_handle(crl)
+                POOL.release(active[crl]['key'], crl, discard=True)
+
+        return self.jobs
 
 
 class WPToolsFetch(object):
@@ -51,8 +350,7 @@ class WPToolsFetch(object):
             "&disabletoc="
             "&format=json"
             "&formatversion=2"
-            "&prop="
-            "text|iwlinks|parsetree|wikitext|displaytitle|properties"
+            "&prop=${props}"
             "&redirects"
             "&page=${thing}")),
         "query": Template((
@@ -70,12 +368,26 @@ class WPToolsFetch(object):
             "&rnnamespace=0"
             "&titles=${thing}")),
         "random": Template((
+            "${WIKI}/w/api.php?action=query"
+            "&exintro"
+            "&exlimit=max"
+            "&format=json"
+            "&formatversion=2"
+            "&generator=random"
+            "&grnlimit=${limit}"
+            "&grnnamespace=${namespace}"
+            "&inprop=displaytitle|url"
+            "&pilimit=max"
+            "&pithumbsize=240"
+            "&ppprop=wikibase_item"
+            "&prop=extracts|info|pageimages|pageprops|pageterms")),
+        "random_titles": Template((
             "${WIKI}/w/api.php?action=query"
             "&format=json"
             "&formatversion=2"
             "&list=random"
-            "&rnlimit=1"
-            "&rnnamespace=0")),
+            "&rnlimit=${limit}"
+            "&rnnamespace=${namespace}")),
         "rest": Template((
             "${WIKI}/api/rest_v1${entrypoint}${title}")),
         "wikidata": Template((
@@ -90,9 +402,17 @@ class WPToolsFetch(object):
             "&titles=${title}"))
     }
 
+    # action=parse props read by WPTools (not text, the rendered HTML)
+    PARSE_PROPS = "iwlinks|parsetree|wikitext|properties"
+
+    VALIDATORS = ['etag', 'last-modified']
+
     action = None
+    cobj = None
+    headers = None
     info = None
     silent = False
+    stale = None
     thing = None
     title = None
 
@@ -103,10 +423,56 @@ class WPToolsFetch(object):
         self.verbose = kwargs.get('verbose') or False
         self.wiki = kwargs.get('wiki')
 
-        self.curl_setup(kwargs.get('proxy'), kwargs.get('timeout'))
+        self.page = kwargs.get('page')
+        self.proxy = kwargs.get('proxy')
+        self.timeout = kwargs.get('timeout') or 0
+
+    def cache_response(self, url, body):
+        """
+        put successful response in store.RESPONSES (if enabled), not
+        API errors (e.g. maxlag after retries ran out)
+        """
+        if store.RESPONSES is None or not self.info:
+            return
+        if (self.headers or {}).get('mediawiki-api-error'):
+            return
+        if THROTTLE.retryable(self.info, self.headers):
+            return
+        info = self.info
+        if self.stale and info.get('status') == 304:
+            info = self.revalidated()
+        if info.get('status') == 200:
+            store.RESPONSES.put(url, self.cache_action(), body, info,
+                                self.page)
+
+    def cache_action(self):
+        """
+        returns action name for store.RESPONSES TTLs
+        """
+        if self.action and self.action.startswith('/'):
+            return 'rest'
+        return self.action
 
-    def __del__(self):
-        self.cobj.close()
+    def cached(self, url):
+        """
+        returns body from store.RESPONSES (and sets info), or None.
+        Keeps an expired entry with validators as stale for revalidation
+        """
+        self.stale = None
+        if store.RESPONSES is None:
+            return None
+        entry = store.RESPONSES.get(url, self.cache_action(), stale=True)
+        if entry is None:
+            return None
+        if entry.get('expired'):
+            if [x for x in self.VALIDATORS if entry['info'].get(x)]:
+                self.stale = entry
+            return None
+        self.info = entry['info']
+        self.info['cached'] = True
+        if not self.silent:
+            print("%s (cached)" % self.status_line(), file=sys.stderr)
+        return entry['body']
 
     def curl(self, url):
         """
@@ -119,43 +485,128 @@ class WPToolsFetch(object):
         #                  headers={'User-Agent': self.user_agent})
         # return r.text
 
-        crl = self.cobj
-        try:
-            crl.setopt(pycurl.URL, url)
-        except UnicodeEncodeError:
-            crl.setopt(pycurl.URL, url.encode('utf-8'))
-
-        if not self.silent:
-            print(self.status_line(), file=sys.stderr)
-
-        return self.curl_perform(crl)
+        body = self.cached(url)
+        if body is not None:
+            return body
+
+        key = self.pool_key(url)
+        retries = 0
+        waited = 0
+        while True:
+            wait = THROTTLE.acquire(key[0])
+            if wait > 0:
+                time.sleep(wait)
+                waited += wait
+
+            crl = POOL.acquire(key, self.curl_setup)
+            self.cobj = crl
+
+            try:
+                body = self.curl_perform(crl, self.curl_prepare(crl, url))
+            except pycurl.error:
+                POOL.release(key, crl, discard=True)
+                raise
+            finally:
+                self.cobj = None
+
+            POOL.release(key, crl)
+            if not self.retry(url, retries):
+                break
+            retries += 1
+
+        self.throttle_info(retries, waited)
+        self.cache_response(url, body)
+        return body
 
-    def curl_perform(self, crl):
+    def curl_finish(self, crl, bfr):
         """
-        performs HTTP GET and returns body of response
+        sets info from finished transfer and returns body of response
         """
-        bfr = BytesIO()
-        crl.setopt(crl.WRITEFUNCTION, bfr.write)
-        crl.perform()
         info = curl_info(crl)
+        body = bfr.getvalue()
+        bfr.close()
         if info:
+            POOL.count(info)
+            info['bytes-decoded'] = len(body)
+            info['encoding'] = self.headers.get('content-encoding')
+            for item in self.VALIDATORS:
+                if self.headers.get(item):
+                    info[item] = self.headers[item]
+            if self.stale and info['status'] == 304:
+                for item in self.VALIDATORS:
+                    if not info.get(item) and self.stale['info'].get(item):
+                        info[item] = self.stale['info'][item]
+                info['revalidated'] = True
+                body = self.stale['body']
             if self.verbose and not self.silent:
                 for item in sorted(info):
                     print("  %s: %s" % (item, info[item]), file=sys.stderr)
             self.info = info
-        body = bfr.getvalue()
-        bfr.close()
         return body
 
-    def curl_setup(self, proxy=None, timeout=0):
+    def curl_header(self, line):
+        """
+        HEADERFUNCTION: keep response headers (of the last response)
         """
-        set curl options
+        line = line.decode('iso-8859-1')
+        if line.startswith('HTTP/'):
+            self.headers = {}
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            self.headers[name.strip().lower()] = value.strip()
+
+    def curl_perform(self, crl, bfr):
+        """
+        performs HTTP GET and returns body of response
         """
+        crl.perform()
+        return self.curl_finish(crl, bfr)
+
+    def curl_prepare(self, crl, url):
+        """
+        set per-request curl options, returns response buffer
+        """
+        try:
+            crl.setopt(pycurl.URL, url)
+        except UnicodeEncodeError:
+            crl.setopt(pycurl.URL, url.encode('utf-8'))
+        crl.setopt(pycurl.VERBOSE, bool(self.verbose and not self.silent))
+
+        headers = []
+        if self.stale:
+            if self.stale['info'].get('etag'):
+                headers.append('If-None-Match: %s'
+                               % self.stale['info']['etag'])
+            if self.stale['info'].get('last-modified'):
+                headers.append('If-Modified-Since: %s'
+                               % self.stale['info']['last-modified'])
+        crl.setopt(pycurl.HTTPHEADER, headers)
+
+        self.headers = {}
+        crl.setopt(pycurl.HEADERFUNCTION, self.curl_header)
+
+        bfr = BytesIO()
+        crl.setopt(pycurl.WRITEFUNCTION, bfr.write)
+
+        if not self.silent:
+            print(self.status_line(), file=sys.stderr)
+
+        return bfr
+
+    def curl_setup(self, proxy=None, timeout=None):
+        """
+        returns new Pycurl object with options set
+        """
+        if proxy is None:
+            proxy = self.proxy
+        if timeout is None:
+            timeout = self.timeout
 
         crl = pycurl.Curl()
         crl.setopt(pycurl.USERAGENT, user_agent())
         crl.setopt(pycurl.FOLLOWLOCATION, True)
         crl.setopt(pycurl.CAINFO, certifi.where())
+        crl.setopt(pycurl.ACCEPT_ENCODING, '')  # all supported, decoded
 
         if proxy:
             crl.setopt(pycurl.PROXY, proxy)
@@ -165,11 +616,39 @@ class WPToolsFetch(object):
         if self.verbose and not self.silent:
             crl.setopt(pycurl.VERBOSE, True)
 
-        self.cobj = crl
+        return crl
+
+    def pool_key(self, url):
+        """
+        returns CurlPool key for url
+        """
+        url = urlparse(url)
+        return ("%s://%s" % (url.scheme, url.netloc), self.proxy, self.timeout)
+
+    def retry(self, url, attempt):
+        """
+        returns True if the last response to url should be retried
+        (after THROTTLE.retry() pauses its host)
+        """
+        return THROTTLE.retry(self.pool_key(url)[0], attempt, self.info,
+                              self.headers)
 
-    def query(self, action, thing, pageid=False):
+    def throttle_info(self, retries, waited):
+        """
+        add retries and seconds waited (by THROTTLE) to info, returns info
+        """
+        if self.info is not None:
+            self.info['retries'] = retries
+            self.info['waited'] = "%5.3f" % waited
+        return self.info
+
+    def query(self, action, thing, pageid=False, props=None, section=None,
+              namespace=0):
         """
         returns API query string
+        - props: <str> action=parse props (default: PARSE_PROPS)
+        - section: <int> action=parse only this section
+        - namespace: <int> random pages from this namespace
         """
         if not self.wiki or self.wiki == 'www.wikidata.org':
             self.wiki = "%s.wikipedia.org" % self.lang
@@ -208,6 +687,21 @@ class WPToolsFetch(object):
                 props=props,
                 site=site,
                 title=title)
+            if title and '|' not in title:
+                qry += '&normalize=1'  # single title only
+        elif action == 'random' or action == 'random_titles':
+            qry = self.QUERY[action].substitute(
+                WIKI=tmpl_wiki,
+                limit=int(thing or 1),
+                namespace=int(namespace))
+            thing = None
+        elif action == 'parse':
+            qry = self.QUERY[action].substitute(
+                WIKI=tmpl_wiki,
+                props=props or self.PARSE_PROPS,
+                thing=thing)
+            if section is not None:
+                qry += "&section=%d" % int(section)
         else:
             qry = self.QUERY[action].substitute(
                 WIKI=tmpl_wiki,
@@ -222,10 +716,26 @@ class WPToolsFetch(object):
         if self.variant:
             qry += '&variant=' + self.variant
 
+        if THROTTLE.maxlag is not None and '/w/api.php?' in qry:
+            qry += "&maxlag=%d" % THROTTLE.maxlag
+
         self.action = action
         self.thing = thing
         return qry
 
+    def revalidated(self):
+        """
+        returns info to store for stale entry after 304 Not Modified:
+        the entry's own (status 200, bytes), with the 304's validators
+        """
+        info = dict(self.stale['info'])
+        info.pop('cached', None)
+        info.pop('revalidated', None)
+        for item in self.VALIDATORS:
+            if self.info.get(item):
+                info[item] = self.info[item]
+        return info
+
     def status_line(self):
         """
         returns request status line
@@ -253,6 +763,7 @@ def curl_info(crl):
     url = url.replace("&format=json", '').replace("&formatversion=2", '')
     return {"url": url,
             "user-agent": user_agent(),
+            "connects": crl.getinfo(crl.NUM_CONNECTS),
             "content": crl.getinfo(crl.CONTENT_TYPE),
             "status": crl.getinfo(crl.RESPONSE_CODE),
             "bytes": crl.getinfo(crl.SIZE_DOWNLOAD),
@@ -260,6 +771,16 @@ def curl_info(crl):
             "kB/s": "%3.1f" % kbps}
 
 
+def curl_multi():
+    """
+    returns this thread's pycurl.CurlMulti, kept for all perform()
+    calls since it holds the connections of its transfers
+    """
+    if getattr(MULTI, 'multi', None) is None:
+        MULTI.multi = pycurl.CurlMulti()
+    return MULTI.multi
+
+
 def get(action, title):
     """
     returns GET result from API
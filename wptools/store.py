@@ -0,0 +1,334 @@
+# -*- coding:utf-8 -*-
+
+"""
+WPTools Store module.
+~~~~~~~~~~~~~~~~~~~~~
+
+Process-wide stores shared by all pages.
+"""
+
+import atexit
+import calendar
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from collections import deque
+
+
+class LRUStore(object):
+    """
+    Thread-safe LRU mapping of text keys, optionally backed by a JSON
+    file that is loaded on creation and saved at exit (or by save())
+    """
+
+    def __init__(self, maxsize=100000, path=None):
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        self.path = path
+        self.stats = {'evicted': 0, 'hits': 0, 'misses': 0}
+
+        if path:
+            if os.path.exists(path):
+                self.load()
+            atexit.register(self.save)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        """
+        remove all items
+        """
+        with self.lock:
+            self.data.clear()
+
+    def get(self, key, default=None):
+        """
+        returns value for key (most recently used) or default
+        """
+        with self.lock:
+            if key not in self.data:
+                self.stats['misses'] += 1
+                return default
+            self.stats['hits'] += 1
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+
+    def load(self):
+        """
+        load items from path
+        """
+        with open(self.path) as _file:
+            items = json.load(_file)
+        for key, value in items:
+            self.set(key, value)
+
+    def save(self):
+        """
+        save items to path (least recently used first)
+        """
+        if not self.path:
+            return
+        with self.lock:
+            items = list(self.data.items())
+        tmp = "%s.%d" % (self.path, os.getpid())
+        with open(tmp, 'w') as _file:
+            json.dump(items, _file)
+        os.rename(tmp, self.path)
+
+    def set(self, key, value):
+        """
+        set key to value, evicting least recently used items
+        """
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.stats['evicted'] += 1
+
+
+class ResponseCache(object):
+    """
+    Persistent (SQLite) HTTP response cache keyed by query URL
+
+    Stores the raw body, curl info (including ETag/Last-Modified
+    validators) and fetch time of each response. Entries expire after
+    a per-action TTL (seconds, 0 = never cache), but stay available
+    for conditional revalidation until evicted. The oldest entries are
+    evicted beyond maxbytes, and invalidate() drops a page's entries
+    fetched before it was last touched.
+    """
+
+    TTL = {'claims': 7 * 86400,
+           'imageinfo': 7 * 86400,
+           'parse': 86400,
+           'query': 86400,
+           'random': 0,
+           'rest': 86400,
+           'wikidata': 86400}
+
+    def __init__(self, path='wptools.sqlite', ttl=None, maxbytes=2 ** 30):
+        self.lock = threading.Lock()
+        self.maxbytes = maxbytes
+        self.path = path
+        self.stats = {'evicted': 0, 'expired': 0, 'hits': 0, 'misses': 0}
+        self.ttl = dict(self.TTL)
+        if ttl:
+            self.ttl.update(ttl)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT PRIMARY KEY, action TEXT, page TEXT, body BLOB, "
+            "info TEXT, fetched REAL, size INTEGER)")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_page ON responses (page)")
+        self.conn.commit()
+
+    def clear(self):
+        """
+        remove all entries
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+
+    def evict(self):
+        """
+        delete oldest entries until under maxbytes
+        """
+        with self.lock:
+            total = self.conn.execute(
+                "SELECT TOTAL(size) FROM responses").fetchone()[0]
+            if total <= self.maxbytes:
+                return
+            rows = self.conn.execute(
+                "SELECT url, size FROM responses ORDER BY fetched")
+            drop = []
+            for url, size in rows:
+                if total <= self.maxbytes:
+                    break
+                drop.append((url,))
+                total -= size
+            self.conn.executemany("DELETE FROM responses WHERE url = ?", drop)
+            self.conn.commit()
+            self.stats['evicted'] += len(drop)
+
+    def get(self, url, action, stale=False):
+        """
+        returns unexpired entry dict {body, info, fetched} or None,
+        or expired entry marked {expired: True} if stale
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT body, info, fetched FROM responses WHERE url = ?",
+                (url,)).fetchone()
+            if not row:
+                self.stats['misses'] += 1
+                return
+            entry = {'body': bytes(row[0]),
+                     'info': json.loads(row[1]),
+                     'fetched': row[2]}
+            if time.time() - row[2] > self.ttl.get(action, 0):
+                self.stats['expired'] += 1
+                if stale:
+                    entry['expired'] = True
+                    return entry
+                return
+            self.stats['hits'] += 1
+            return entry
+
+    def invalidate(self, page, touched):
+        """
+        delete page entries fetched before touched (ISO 8601 timestamp)
+        """
+        since = timestamp(touched)
+        if not page or since is None:
+            return
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM responses WHERE page = ? AND fetched < ?",
+                (page, since))
+            self.conn.commit()
+
+    def put(self, url, action, body, info, page=None):
+        """
+        store response body and info for url (if action has a TTL)
+        """
+        if not self.ttl.get(action):
+            return
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, action, page, sqlite3.Binary(body), json.dumps(info),
+                 time.time(), len(body)))
+            self.conn.commit()
+        self.evict()
+
+
+class RandomPool(object):
+    """
+    Thread-safe pools of random pages by key, e.g. (lang, wiki,
+    namespace). get() takes a page from the pool, refilling it at once
+    when empty, and in a background thread when it drops below lowat.
+    """
+
+    def __init__(self, lowat=100):
+        self.lock = threading.Lock()
+        self.lowat = lowat
+        self.pools = {}
+        self.refilling = set()
+        self.stats = {'hits': 0, 'misses': 0, 'refills': 0}
+
+    def _background(self, key, refill):
+        """
+        refill pool in a thread (once at a time per key)
+        """
+        with self.lock:
+            if key in self.refilling:
+                return
+            self.refilling.add(key)
+
+        def _refill():
+            try:
+                self.refill(key, refill)
+            except Exception:  # the next get() refills at once
+                pass
+            finally:
+                with self.lock:
+                    self.refilling.discard(key)
+
+        thread = threading.Thread(target=_refill)
+        thread.daemon = True
+        thread.start()
+
+    def clear(self):
+        """
+        empty all pools
+        """
+        with self.lock:
+            self.pools.clear()
+
+    def count(self, key):
+        """
+        returns number of pages left in pool key
+        """
+        with self.lock:
+            return len(self.pools.get(key, ()))
+
+    def get(self, key, refill):
+        """
+        returns next page from pool key, or None if refill() finds none
+        - refill: <callable> returns list of pages for pool
+        """
+        item = self.pop(key)
+        if item is None:
+            self.stats['misses'] += 1
+            self.refill(key, refill)
+            item = self.pop(key)
+        else:
+            self.stats['hits'] += 1
+
+        if self.count(key) < self.lowat:
+            self._background(key, refill)
+
+        return item
+
+    def pop(self, key):
+        """
+        returns next page from pool key, or None
+        """
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool:
+                return pool.popleft()
+
+    def refill(self, key, refill):
+        """
+        add refill() pages to pool key
+        """
+        items = refill()
+        with self.lock:
+            self.pools.setdefault(key, deque()).extend(items)
+            self.stats['refills'] += 1
+
+
+def timestamp(iso):
+    """
+    returns epoch seconds from ISO 8601 (UTC) timestamp, or None
+    """
+    try:
+        return calendar.timegm(time.strptime(iso, '%Y-%m-%dT%H:%M:%SZ'))
+    except (TypeError, ValueError):
+        return None
+
+
+# Wikidata labels by "<Q-id>|<lang or variant>", used by get_claims().
+# For on-disk backing: wptools.store.LABELS = LRUStore(path='labels.json')
+LABELS = LRUStore()
+
+# API:Imageinfo data (url, size, width, height, timestamp, ...) by
+# normalized "File:" title, or "<wiki or lang>|File:" title for local
+# (not Commons) files, used by get_imageinfo().
+# For on-disk backing: wptools.store.IMAGES = LRUStore(path='images.json')
+IMAGES = LRUStore()
+
+# Random (pageid, title) by (lang, wiki, namespace) for wptools.page()
+# without title, pageid or wikibase. To tune: RANDOM.lowat = 1000
+RANDOM = RandomPool()
+
+# Persistent HTTP responses, off by default.
+# To enable: wptools.store.RESPONSES = ResponseCache('wptools.sqlite')
+RESPONSES = None
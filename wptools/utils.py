@@ -18,6 +18,7 @@ import hashlib
 import json
 
 from collections import defaultdict
+from io import BytesIO
 from itertools import chain
 
 import lxml.etree
@@ -25,14 +26,270 @@ import lxml.html
 
 from lxml.etree import tostring
 
+# media_url() memo, by arguments
+MEDIA_URLS = {}
+MEDIA_URLS_MAX = 100000
+
+# wikitext tokens scanned by get_wikitext_infobox()
+WIKITEXT_TOKENS = re.compile(
+    r'\{\{|\}\}|\[\[|\]\]|\||<!--.*?(?:-->|$)'
+    r'|<ref\b[^>]*?/>|<ref\b[^>]*>|</ref\s*>'
+    r'|<nowiki>.*?</nowiki>', re.DOTALL | re.IGNORECASE)
+
+# top-level tokens of template parts, with <ref> and nowiki opaque
+WIKITEXT_SPLIT = re.compile(
+    r'\{\{|\}\}|\[\[|\]\]|\||<ref\b[^>]*?/>|<ref\b[^>]*>.*?</ref\s*>'
+    r'|<nowiki>.*?</nowiki>', re.DOTALL | re.IGNORECASE)
+
+WIKITEXT_COMMENT = re.compile(r'<!--.*?(?:-->|$)', re.DOTALL)
+
+# snip_html() drops elements whose class contains any of SNIP_CLASSES,
+# or whose tag is in SNIP_TAGS. To tune: SNIP_TAGS = ('style',)
+SNIP_CLASSES = ('metadata', 'noexcerpt', 'noprint', 'reference', 'haudio')
+SNIP_TAGS = ()
+
+# snip_html() placeholders, copied for each element dropped
+SNIP_SPANS = {'ignored': lxml.html.fromstring("<span ignored>"),
+              'removed': lxml.html.fromstring("<span removed>")}
+
+# thumbnail (prefix, suffix) by file extension, default ('', '')
+THUMB_FORMATS = {'djvu': ('page1-', '.jpg'),
+                 'pdf': ('page1-', '.jpg'),
+                 'svg': ('', '.png'),
+                 'tif': ('lossy-page1-', '.jpg'),
+                 'tiff': ('lossy-page1-', '.jpg')}
+
+
+class LazyAttribute(object):
+    """
+    class attribute set on first read from instance._deferred[name]()
+    (default None), then kept in the instance like any other attribute
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        func = obj.__dict__.get('_deferred', {}).pop(self.name, None)
+        if func is None:
+            return None
+        value = func()
+        setattr(obj, self.name, value)
+        return value
+
+
+class LazyImage(dict):
+    """
+    image dict (e.g. with offline URLs) that calls resolve() once, on
+    first read of a LAZY key it does not have yet
+    """
+
+    LAZY = ['height', 'size', 'timestamp', 'width']
+
+    def __init__(self, data, resolve):
+        super(LazyImage, self).__init__(data)
+        self.resolve = resolve
+
+    def __missing__(self, key):
+        if key in self.LAZY and self.resolve:
+            self.resolve()
+            self.resolve = None
+            if key in self:
+                return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def description_url(fname, wiki='https://commons.wikimedia.org'):
+    """
+    returns File: description page URL from name
+    """
+    title = file_title(fname).replace(' ', '_')
+    try:
+        return "%s/wiki/%s" % (wiki, quote(title))
+    except KeyError:
+        return "%s/wiki/%s" % (wiki, quote(title.encode('utf-8')))
+
+
+def file_title(fname):
+    """
+    returns normalized File: title of image filename
+    """
+    name = re.sub(r'^(file|image):', '', fname, flags=re.IGNORECASE)
+    name = name.replace('_', ' ').strip()
+    return 'File:' + name[:1].upper() + name[1:]
+
 
 def get_infobox(ptree):
     """
     returns infobox <type 'dict'> from get_parse:parsetreee
+
+    Streams the parse tree (iterparse) and stops at the end of the
+    first template (in document order) whose title contains "box",
+    clearing templates before it, so the rest is never parsed.
+    """
+    if not isinstance(ptree, bytes):
+        ptree = ptree.encode('utf-8')
+
+    found = None
+    for _, elem in lxml.etree.iterparse(BytesIO(ptree),
+                                        tag=('template', 'title')):
+        if elem.tag == 'title':
+            if found is None and elem.getparent().tag == 'template':
+                if "box" in (elem.text or ''):
+                    found = elem.getparent()
+        elif elem is found:
+            return template_to_dict(elem)
+        elif found is None:
+            elem.clear()
+
+
+def get_wikitext_infobox(wikitext):
+    """
+    returns infobox <type 'dict'> from wikitext (e.g. get_parse:wikitext
+    or url_raw), like get_infobox() without the parse tree
+
+    A single scan keeps a stack of open {{templates}}, [[links]] and
+    <ref>s (skipping comments and nowiki), noting the top-level pipes
+    of each template, and stops at the end of the first template (in
+    document order) whose title contains "box".
+    """
+    found = None
+    stack = []
+    for match in WIKITEXT_TOKENS.finditer(wikitext):
+        token = match.group()
+        if token in ('{{', '[['):
+            stack.append([token, match.start(), []])
+        elif token == '}}':
+            while stack and stack[-1][0] != '{{':
+                stack.pop()
+            if not stack:
+                continue
+            frame = stack.pop()
+            if found is None and not frame[2]:
+                found = _wikitext_title(wikitext, frame, match.start())
+            if frame is found:
+                return _wikitext_dict(wikitext, frame, match.start())
+        elif token == ']]':
+            if stack and stack[-1][0] == '[[':
+                stack.pop()
+        elif token == '|':
+            if stack and stack[-1][0] == '{{':
+                frame = stack[-1]
+                if found is None and not frame[2]:
+                    found = _wikitext_title(wikitext, frame, match.start())
+                frame[2].append(match.start())
+        elif token.lower().startswith('<ref') and not token.endswith('/>'):
+            stack.append(['<ref', match.start(), []])
+        elif token.lower().startswith('</ref'):
+            while stack and stack[-1][0] != '<ref':
+                stack.pop()
+            if stack:
+                stack.pop()
+
+
+def _wikitext_dict(wikitext, frame, end):
+    """
+    returns template_to_dict() of template frame ending at end
+    """
+    obj = {}
+    bounds = frame[2] + [end]
+    for i, sep in enumerate(frame[2]):
+        part = wikitext[sep + 1:bounds[i + 1]]
+        equals = _wikitext_equals(part)
+        if equals is None:
+            continue
+        name = WIKITEXT_COMMENT.sub('', part[:equals]).strip()
+        value = WIKITEXT_COMMENT.sub('', part[equals + 1:])
+        template = _wikitext_split(value)
+        if len(template) > 1:
+            value = "{{%s}}" % "|".join(_wikitext_pieces(template[1]))
+        if name and value:
+            obj[name] = value.strip()
+    return obj
+
+
+def _wikitext_equals(part):
+    """
+    returns index of "=" naming template part, or None if positional
+    """
+    equals = part.find('=')
+    if equals < 0 or re.search(r'\{\{|\[\[|<', part[:equals]):
+        return None
+    return equals
+
+
+def _wikitext_pieces(template):
+    """
+    returns text pieces of "{{...}}" template source, as parse tree
+    text nodes (cf. template_to_text)
+    """
+    parts = _wikitext_split(template[2:-2], '|')
+    pieces = _wikitext_text(parts[0])
+    for part in parts[1:]:
+        equals = _wikitext_equals(part)
+        if equals is not None:
+            pieces += [part[:equals], '=']
+            part = part[equals + 1:]
+        pieces += _wikitext_text(part)
+    return [x for x in pieces if x]
+
+
+def _wikitext_split(text, sep=None):
+    """
+    returns text split at top-level sep (not in {{}}, [[]] or <ref>), or if
+    not sep, split around the first top-level {{template}}
+    """
+    parts = []
+    depth = 0
+    start = 0
+    begin = None
+    for match in WIKITEXT_SPLIT.finditer(text):
+        token = match.group()
+        if token.startswith('<'):
+            continue
+        if token in ('{{', '[['):
+            if not sep and token == '{{' and depth == 0:
+                begin = match.start()
+            depth += 1
+        elif token in ('}}', ']]'):
+            depth = max(0, depth - 1)
+            if not sep and token == '}}' and depth == 0 and begin is not None:
+                return [text[:begin], text[begin:match.end()],
+                        text[match.end():]]
+        elif sep and depth == 0:
+            parts.append(text[start:match.start()])
+            start = match.end()
+    if not sep:
+        return [text]
+    return parts + [text[start:]]
+
+
+def _wikitext_text(text):
+    """
+    returns pieces of text with nested templates flattened
+    """
+    split = _wikitext_split(text)
+    if len(split) == 1:
+        return [text]
+    return ([split[0]] + _wikitext_pieces(split[1])
+            + _wikitext_text(split[2]))
+
+
+def _wikitext_title(wikitext, frame, end):
+    """
+    returns template frame if its title (up to end) contains "box"
     """
-    for item in lxml.etree.fromstring(ptree).xpath("//template"):
-        if "box" in item.find('title').text:
-            return template_to_dict(item)
+    title = WIKITEXT_COMMENT.sub('', wikitext[frame[1] + 2:end])
+    if "box" in title:
+        return frame
 
 
 def get_links(iwlinks):
@@ -74,10 +331,13 @@ def json_loads(data):
 def media_url(fname, namespace='commons',
               wiki='https://upload.wikimedia.org/wikipedia'):
     """
-    return Wikimedia File/Image URL from name
+    return Wikimedia File/Image URL from name (memoized)
     """
-    name = re.sub(r'^(File|Image):', '', fname).replace(' ', '_')
-    name = re.sub(r'^(file|image):', '', fname).replace(' ', '_')
+    key = (fname, namespace, wiki)
+    if key in MEDIA_URLS:
+        return MEDIA_URLS[key]
+
+    name = file_title(fname)[len('File:'):].replace(' ', '_')
 
     try:
         digest = hashlib.md5(name).hexdigest()
@@ -89,7 +349,11 @@ def media_url(fname, namespace='commons',
     except KeyError:
         path = "/".join([digest[:1], digest[:2], name])
 
-    return "/".join([wiki, namespace, path])
+    if len(MEDIA_URLS) >= MEDIA_URLS_MAX:
+        MEDIA_URLS.clear()
+    MEDIA_URLS[key] = "/".join([wiki, namespace, path])
+
+    return MEDIA_URLS[key]
 
 
 def pretty(data):
@@ -102,7 +366,7 @@ def pretty(data):
                       separators=(',', ': '))
 
 
-def snip_html(text, verbose=0):
+def snip_html(text, verbose=0, classes=None, tags=None):
     """
     removed unwanted elements from HTML
 
@@ -112,68 +376,70 @@ def snip_html(text, verbose=0):
         0 = silent
         1 = show replacements (stderr)
         2 = inspect descendants (stderr)
+    classes
+        class substrings to drop (default: SNIP_CLASSES)
+    tags
+        tags to drop (default: SNIP_TAGS)
     """
+    if classes is None:
+        classes = SNIP_CLASSES
+    tags = frozenset(SNIP_TAGS if tags is None else tags)
 
     def _inspect(elem, sub=False):
-        if verbose > 1:
-            print("\n", file=sys.stderr)
-            if sub:
-                print("+ %s" % lxml.html.tostring(elem), file=sys.stderr)
-            else:
-                print("%s" % lxml.html.tostring(elem), file=sys.stderr)
-            print("  class: %s" % elem.get('class'), file=sys.stderr)
-            print("  href: %s" % elem.get('href'), file=sys.stderr)
-            print("  id: %s" % elem.get('id'), file=sys.stderr)
-            print("  tag: %s" % elem.tag, file=sys.stderr)
-            print("  tail: %s" % elem.tail, file=sys.stderr)
-            print("  text: %s" % elem.text, file=sys.stderr)
+        print("\n", file=sys.stderr)
+        if sub:
+            print("+ %s" % lxml.html.tostring(elem), file=sys.stderr)
+        else:
+            print("%s" % lxml.html.tostring(elem), file=sys.stderr)
+        print("  class: %s" % elem.get('class'), file=sys.stderr)
+        print("  href: %s" % elem.get('href'), file=sys.stderr)
+        print("  id: %s" % elem.get('id'), file=sys.stderr)
+        print("  tag: %s" % elem.tag, file=sys.stderr)
+        print("  tail: %s" % elem.tail, file=sys.stderr)
+        print("  text: %s" % elem.text, file=sys.stderr)
 
     def _note(old, new):
-        old = lxml.html.tostring(old).strip()
-        new = lxml.html.tostring(new).strip()
-        if verbose > 0:
-            print("\n%s REPLACING: %s WITH: %s"
-                  % (snip_html.__name__, old, new),
-                  file=sys.stderr)
-
-    def _span(note, text):
-        span = lxml.html.fromstring("<span %s>" % note)
-        span.tail = text
-        return span
-
-    def _exclude(_class):
-        return ('metadata' in _class
-                or 'noexcerpt' in _class
-                or 'noprint' in _class
-                or 'reference' in _class
-                or 'haudio' in _class)
+        print("\n%s REPLACING: %s WITH: %s"
+              % (snip_html.__name__,
+                 lxml.html.tostring(old).strip(),
+                 lxml.html.tostring(new).strip()),
+              file=sys.stderr)
 
-    keep = lxml.html.Element("span")
-    for elem in lxml.html.fromstring(text):
-        _inspect(elem)
-
-        # ignore selected elements entirely, keeping tail
-        elem_class = elem.get('class')
-        if elem_class:
-            if _exclude(elem_class):
-                span = _span('ignored', elem.tail or '')
-                keep.append(span)
-                _note(elem, span)
+    root = lxml.html.fromstring(text)
+
+    if verbose > 1:
+        for elem in root:
+            _inspect(elem)
+            for desc in elem.iterdescendants():
+                _inspect(desc, True)
+
+    # one pass finds all elements to drop (not inside one dropped)
+    dropped = []
+    seen = set()
+    rule = _snip_rule(classes)
+    for elem in root.iterdescendants(lxml.etree.Element):
+        if elem.tag not in tags:
+            _class = elem.get('class')
+            if not (_class and rule and rule.search(_class)):
                 continue
+        if dropped and any(x in seen for x in elem.iterancestors()):
+            continue
+        dropped.append(elem)
+        seen.add(elem)
+
+    # ignore selected elements entirely (or replace selected
+    # descendants), keeping tail
+    for elem in dropped:
+        parent = elem.getparent()
+        span = SNIP_SPANS['ignored' if parent is root else 'removed']
+        span = span.__copy__()
+        span.tail = elem.tail
+        parent.replace(elem, span)
+        if verbose > 0:
+            _note(elem, span)
 
-        # remove selected descendants, keeping tail
-        for desc in elem.iterdescendants():
-            _inspect(desc, True)
-            desc_class = desc.get('class')
-            if desc_class:
-                if _exclude(desc_class):
-                    desc.getparent().remove(desc)
-                    span = _span('removed', desc.tail or '')
-                    _note(desc, span)
-                    elem.append(span)
-                    break
-
-        keep.append(elem)
+    keep = lxml.html.Element("span")
+    keep.extend(list(root))
 
     leading_text = text.split('<')[0]
     keep_html = lxml.html.tostring(keep, encoding='unicode')
@@ -181,6 +447,14 @@ def snip_html(text, verbose=0):
     return leading_text + keep_html
 
 
+def _snip_rule(classes):
+    """
+    returns compiled regex of class substrings, or None
+    """
+    if classes:
+        return re.compile("|".join([re.escape(x) for x in classes]))
+
+
 def span_classes(frag):
     """
     returns list of <span> classes found in <frag>
@@ -209,6 +483,18 @@ def stderr(msg, silent=False):
         print(msg, file=sys.stderr)
 
 
+def thumb_url(url, width):
+    """
+    returns thumbnail URL of width (px) from media_url
+    e.g. .../commons/thumb/a/ab/Name.svg/220px-Name.svg.png
+    """
+    base, digest1, digest2, name = url.rsplit('/', 3)
+    ext = name.rsplit('.', 1)[-1].lower()
+    prefix, suffix = THUMB_FORMATS.get(ext, ('', ''))
+    thumb = "%s%dpx-%s%s" % (prefix, int(width), name, suffix)
+    return "/".join([base, 'thumb', digest1, digest2, name, thumb])
+
+
 def template_to_dict(tree):
     """
     returns wikitext template as dict (one deep)